@@ -0,0 +1,115 @@
+"""
+Battery history for Kevinbot v3
+Fixed-size ring buffer of timestamped pack voltages with state of charge and runtime estimation
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+@dataclass
+class PackEstimate:
+    voltage: float
+    soc: float
+    rate: float  # state of charge per hour, negative while discharging
+    runtime: Optional[float]  # seconds until cutoff, None when not discharging
+
+
+class BatteryHistory:
+    def __init__(self, cutoff_voltages: Sequence[float], warn_voltages: Sequence[float],
+                 full_voltages: Sequence[float], warn_soc: float = 0.2, capacity: int = 36000):
+        if not 0 < warn_soc < 1:
+            raise ValueError(f"warn_soc must be in (0, 1), got {warn_soc}")
+
+        self.packs = len(cutoff_voltages)
+        self.capacity = capacity
+
+        cutoff = np.asarray(cutoff_voltages, dtype=np.float64)
+        warn = np.asarray(warn_voltages, dtype=np.float64)
+        full = np.asarray(full_voltages, dtype=np.float64)
+        self._soc_points = [(np.array([c, w, f]), np.array([0.0, warn_soc, 1.0]))
+                            for c, w, f in zip(cutoff, warn, full)]
+
+        # every sample is written twice so buf[head:head + capacity] is always a
+        # contiguous, chronologically ordered view with no copying
+        self._times = np.zeros(capacity * 2, dtype=np.float64)
+        self._volts = np.zeros((capacity * 2, self.packs), dtype=np.float64)
+        self._head = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, battery_settings: dict):
+        return cls(battery_settings["cutoff_voltages"],
+                   battery_settings["warn_voltages"],
+                   battery_settings["full_voltages"],
+                   warn_soc=battery_settings.get("warn_soc", 0.2),
+                   capacity=battery_settings.get("history_size", 36000))
+
+    def __len__(self):
+        return self._count
+
+    def append(self, voltages: Sequence[float], timestamp: Optional[float] = None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        with self._lock:
+            index = (self._head + self._count) % self.capacity
+            for slot in (index, index + self.capacity):
+                self._times[slot] = timestamp
+                self._volts[slot] = voltages[:self.packs]
+
+            if self._count < self.capacity:
+                self._count += 1
+            else:
+                self._head = (self._head + 1) % self.capacity
+
+    def window(self, seconds: Optional[float] = None):
+        """Return (times, voltages) views for the last `seconds` of history, oldest first"""
+        with self._lock:
+            start, end = self._head, self._head + self._count
+            times = self._times[start:end]
+            volts = self._volts[start:end]
+            if seconds is not None and self._count:
+                first = np.searchsorted(times, times[-1] - seconds)
+                times, volts = times[first:], volts[first:]
+            return times.copy(), volts.copy()
+
+    def soc(self, voltages) -> np.ndarray:
+        voltages = np.asarray(voltages, dtype=np.float64)
+        return np.stack([np.interp(voltages[..., pack], *self._soc_points[pack])
+                         for pack in range(self.packs)], axis=-1)
+
+    def estimate(self, smoothing: float = 30.0, trend: float = 300.0) -> List[PackEstimate]:
+        times, volts = self.window(max(smoothing, trend))
+        if not len(times):
+            return []
+
+        socs = self.soc(volts)
+        recent = times >= times[-1] - smoothing
+        smoothed = socs[recent].mean(axis=0)
+        voltage = volts[recent].mean(axis=0)
+
+        # least-squares slope of state of charge over the trend window
+        trend_mask = times >= times[-1] - trend
+        t = times[trend_mask]
+        dt = t - t.mean()
+        denom = np.dot(dt, dt)
+        if denom > 0:
+            slopes = dt @ (socs[trend_mask] - socs[trend_mask].mean(axis=0)) / denom
+        else:
+            slopes = np.zeros(self.packs)
+
+        estimates = []
+        for pack in range(self.packs):
+            rate = float(slopes[pack])
+            runtime = float(smoothed[pack] / -rate) if rate < 0 else None
+            estimates.append(PackEstimate(voltage=round(float(voltage[pack]), 3),
+                                          soc=round(float(smoothed[pack]), 4),
+                                          rate=rate * 3600,
+                                          runtime=runtime))
+        return estimates
@@ -0,0 +1,108 @@
+"""
+Filtered battery monitor for Kevinbot v3
+Applies EWMA filtering and hysteresis to each pack and raises one event per alarm state change
+"""
+
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from enum import IntEnum
+from typing import Callable, List, Optional, Sequence
+
+
+class BatteryState(IntEnum):
+    OK = 0
+    WARN = 1
+    CRITICAL = 2
+    CUTOFF = 3
+
+
+@dataclass
+class PackThresholds:
+    warn: float
+    critical: float
+    cutoff: float
+
+
+@dataclass
+class _PackStatus:
+    thresholds: PackThresholds
+    filtered: Optional[float] = None
+    state: BatteryState = BatteryState.OK
+
+
+TransitionCallback = Callable[[int, BatteryState, BatteryState, float], None]
+
+
+def thresholds_from_settings(battery_settings: dict) -> List[PackThresholds]:
+    warn = battery_settings["warn_voltages"]
+    cutoff = battery_settings["cutoff_voltages"]
+    # critical sits halfway between warn and cutoff unless configured
+    critical = battery_settings.get("critical_voltages",
+                                    [(w + c) / 2 for w, c in zip(warn, cutoff)])
+    return [PackThresholds(w, cr, c) for w, cr, c in zip(warn, critical, cutoff)]
+
+
+@dataclass
+class BatteryMonitor:
+    thresholds: Sequence[PackThresholds]
+    alpha: float = 0.2
+    hysteresis: float = 0.2
+    enabled_packs: int = 2
+    on_transition: Optional[TransitionCallback] = None
+    _packs: List[_PackStatus] = dataclass_field(init=False, default_factory=list)
+
+    def __post_init__(self):
+        if not 0 < self.alpha <= 1:
+            raise ValueError(f"EWMA alpha must be in (0, 1], got {self.alpha}")
+        self._packs = [_PackStatus(t) for t in self.thresholds]
+
+    @classmethod
+    def from_settings(cls, battery_settings: dict, on_transition: Optional[TransitionCallback] = None):
+        return cls(thresholds_from_settings(battery_settings),
+                   alpha=battery_settings.get("filter_alpha", 0.2),
+                   hysteresis=battery_settings.get("hysteresis", 0.2),
+                   enabled_packs=2 if battery_settings.get("enable_two", True) else 1,
+                   on_transition=on_transition)
+
+    @property
+    def states(self) -> List[BatteryState]:
+        return [pack.state for pack in self._packs]
+
+    @property
+    def filtered(self) -> List[Optional[float]]:
+        return [pack.filtered for pack in self._packs]
+
+    def reset(self):
+        """Forget filter history and return every pack to OK without firing events"""
+        for pack in self._packs:
+            pack.filtered = None
+            pack.state = BatteryState.OK
+
+    def update(self, voltages: Sequence[float]):
+        for index, voltage in enumerate(voltages[:min(self.enabled_packs, len(self._packs))]):
+            self._update_pack(index, voltage)
+
+    def _update_pack(self, index: int, voltage: float):
+        pack = self._packs[index]
+        if pack.filtered is None:
+            pack.filtered = voltage
+        else:
+            pack.filtered += self.alpha * (voltage - pack.filtered)
+
+        new_state = self._classify(pack.filtered, pack.thresholds, pack.state)
+        if new_state != pack.state:
+            old_state = pack.state
+            pack.state = new_state
+            if self.on_transition:
+                self.on_transition(index, old_state, new_state, pack.filtered)
+
+    def _classify(self, voltage: float, thresholds: PackThresholds, current: BatteryState) -> BatteryState:
+        state = BatteryState.OK
+        for level, threshold in ((BatteryState.WARN, thresholds.warn),
+                                 (BatteryState.CRITICAL, thresholds.critical),
+                                 (BatteryState.CUTOFF, thresholds.cutoff)):
+            # leaving a level we're already in requires climbing past the hysteresis band
+            margin = self.hysteresis if level <= current else 0
+            if voltage < threshold + margin:
+                state = level
+        return state
@@ -0,0 +1,201 @@
+"""
+BME280 driver for Kevinbot v3
+Reads temperature, pressure and humidity in one burst transaction and compensates them together
+"""
+
+import struct
+import time
+from dataclasses import dataclass
+from typing import Tuple
+
+CHIP_ID = 0x60
+
+REG_CALIB_00 = 0x88
+REG_CHIP_ID = 0xD0
+REG_RESET = 0xE0
+REG_CALIB_26 = 0xE1
+REG_CTRL_HUM = 0xF2
+REG_STATUS = 0xF3
+REG_CTRL_MEAS = 0xF4
+REG_CONFIG = 0xF5
+REG_DATA = 0xF7
+
+MODE_SLEEP = 0b00
+MODE_FORCED = 0b01
+MODE_NORMAL = 0b11
+
+# oversampling factor -> register code (0 skips the measurement)
+OVERSAMPLING = {0: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+# IIR filter coefficient -> register code
+FILTER = {0: 0, 2: 1, 4: 2, 8: 3, 16: 4}
+# normal mode standby time in ms -> register code
+STANDBY = {0.5: 0, 62.5: 1, 125: 2, 250: 3, 500: 4, 1000: 5, 10: 6, 20: 7}
+
+
+@dataclass
+class Calibration:
+    t1: int
+    t2: int
+    t3: int
+    p1: int
+    p2: int
+    p3: int
+    p4: int
+    p5: int
+    p6: int
+    p7: int
+    p8: int
+    p9: int
+    h1: int
+    h2: int
+    h3: int
+    h4: int
+    h5: int
+    h6: int
+
+    @classmethod
+    def from_registers(cls, block0: bytes, block1: bytes):
+        t_p = struct.unpack("<HhhHhhhhhhhh", block0[:24])
+        h1 = block0[25]
+        h2, h3 = struct.unpack("<hB", block1[:3])
+        e4, e5, e6 = block1[3], block1[4], block1[5]
+        h4 = _signed12((e4 << 4) | (e5 & 0x0F))
+        h5 = _signed12((e6 << 4) | (e5 >> 4))
+        h6 = struct.unpack("<b", block1[6:7])[0]
+        return cls(*t_p, h1, h2, h3, h4, h5, h6)
+
+
+def _signed12(value: int) -> int:
+    return value - 0x1000 if value & 0x800 else value
+
+
+@dataclass
+class BME280Reading:
+    temperature: float  # °C
+    humidity: float  # %RH
+    pressure: float  # hPa
+
+
+def compensate(cal: Calibration, adc_t: int, adc_p: int, adc_h: int) -> BME280Reading:
+    """Bosch floating point compensation, temperature is computed once and shared"""
+    var1 = (adc_t / 16384.0 - cal.t1 / 1024.0) * cal.t2
+    var2 = (adc_t / 131072.0 - cal.t1 / 8192.0) ** 2 * cal.t3
+    t_fine = var1 + var2
+    temperature = t_fine / 5120.0
+
+    var1 = t_fine / 2.0 - 64000.0
+    var2 = var1 * var1 * cal.p6 / 32768.0
+    var2 = var2 + var1 * cal.p5 * 2.0
+    var2 = var2 / 4.0 + cal.p4 * 65536.0
+    var1 = (cal.p3 * var1 * var1 / 524288.0 + cal.p2 * var1) / 524288.0
+    var1 = (1.0 + var1 / 32768.0) * cal.p1
+    if var1 == 0:
+        pressure = 0.0
+    else:
+        pressure = 1048576.0 - adc_p
+        pressure = (pressure - var2 / 4096.0) * 6250.0 / var1
+        var1 = cal.p9 * pressure * pressure / 2147483648.0
+        var2 = pressure * cal.p8 / 32768.0
+        pressure = pressure + (var1 + var2 + cal.p7) / 16.0
+
+    humidity = t_fine - 76800.0
+    humidity = ((adc_h - (cal.h4 * 64.0 + cal.h5 / 16384.0 * humidity))
+                * (cal.h2 / 65536.0 * (1.0 + cal.h6 / 67108864.0 * humidity
+                                       * (1.0 + cal.h3 / 67108864.0 * humidity))))
+    humidity = humidity * (1.0 - cal.h1 * humidity / 524288.0)
+    humidity = min(max(humidity, 0.0), 100.0)
+
+    return BME280Reading(temperature, humidity, pressure / 100)
+
+
+def unpack_raw(data: bytes) -> Tuple[int, int, int]:
+    adc_p = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+    adc_t = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+    adc_h = (data[6] << 8) | data[7]
+    return adc_t, adc_p, adc_h
+
+
+class BME280:
+    def __init__(self, bus, address: int = 0x77, mode: str = "forced",
+                 oversampling_temperature: int = 1, oversampling_pressure: int = 1,
+                 oversampling_humidity: int = 1, iir_filter: int = 0, standby: float = 0.5):
+        if mode not in ("forced", "normal"):
+            raise ValueError(f"Unknown BME280 mode {mode}")
+
+        self.bus = bus
+        self.address = address
+        self.mode = mode
+        self.osrs_t = oversampling_temperature
+        self.osrs_p = oversampling_pressure
+        self.osrs_h = oversampling_humidity
+
+        chip_id = self.bus.read_byte_data(self.address, REG_CHIP_ID)
+        if chip_id != CHIP_ID:
+            raise RuntimeError(f"No BME280 at 0x{address:02x} (chip id 0x{chip_id:02x})")
+
+        self.bus.write_byte_data(self.address, REG_RESET, 0xB6)
+        time.sleep(0.004)
+        while self.bus.read_byte_data(self.address, REG_STATUS) & 0x01:
+            time.sleep(0.002)
+
+        self.calibration = Calibration.from_registers(
+            bytes(self.bus.read_i2c_block_data(self.address, REG_CALIB_00, 26)),
+            bytes(self.bus.read_i2c_block_data(self.address, REG_CALIB_26, 7)))
+
+        self._ctrl_meas = (OVERSAMPLING[self.osrs_t] << 5) | (OVERSAMPLING[self.osrs_p] << 2)
+        # config can only be written reliably in sleep mode, ctrl_hum only applies after a ctrl_meas write
+        self.bus.write_byte_data(self.address, REG_CONFIG, (STANDBY[standby] << 5) | (FILTER[iir_filter] << 2))
+        self.bus.write_byte_data(self.address, REG_CTRL_HUM, OVERSAMPLING[self.osrs_h])
+        if self.mode == "normal":
+            self.bus.write_byte_data(self.address, REG_CTRL_MEAS, self._ctrl_meas | MODE_NORMAL)
+        else:
+            self.bus.write_byte_data(self.address, REG_CTRL_MEAS, self._ctrl_meas | MODE_SLEEP)
+
+    @classmethod
+    def from_settings(cls, bus, bme_settings: dict):
+        oversampling = bme_settings.get("oversampling", {})
+        return cls(bus,
+                   address=bme_settings.get("address", 0x77),
+                   mode=bme_settings.get("mode", "forced"),
+                   oversampling_temperature=oversampling.get("temperature", 1),
+                   oversampling_pressure=oversampling.get("pressure", 1),
+                   oversampling_humidity=oversampling.get("humidity", 1),
+                   iir_filter=bme_settings.get("filter", 0),
+                   standby=bme_settings.get("standby", 0.5))
+
+    @property
+    def measurement_time(self) -> float:
+        """Maximum conversion time in seconds for the configured oversampling (datasheet 9.1)"""
+        ms = 1.25 + 2.3 * self.osrs_t
+        if self.osrs_p:
+            ms += 2.3 * self.osrs_p + 0.575
+        if self.osrs_h:
+            ms += 2.3 * self.osrs_h + 0.575
+        return ms / 1000
+
+    def start_measurement(self):
+        """Start a forced mode conversion, the result can be read after measurement_time"""
+        if self.mode == "forced":
+            self.bus.write_byte_data(self.address, REG_CTRL_MEAS, self._ctrl_meas | MODE_FORCED)
+
+    def measuring(self) -> bool:
+        return bool(self.bus.read_byte_data(self.address, REG_STATUS) & 0x08)
+
+    def read_result(self) -> BME280Reading:
+        """The last completed conversion, without starting a new one"""
+        return compensate(self.calibration, *self._read_adc())
+
+    def _read_adc(self) -> Tuple[int, int, int]:
+        return unpack_raw(bytes(self.bus.read_i2c_block_data(self.address, REG_DATA, 8)))
+
+    def read_raw(self) -> Tuple[int, int, int]:
+        """Blocking read, in forced mode this starts a conversion and waits for it"""
+        if self.mode == "forced":
+            self.start_measurement()
+            time.sleep(self.measurement_time)
+            while self.measuring():
+                time.sleep(0.001)
+        return self._read_adc()
+
+    def read(self) -> BME280Reading:
+        return compensate(self.calibration, *self.read_raw())
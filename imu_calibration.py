@@ -0,0 +1,219 @@
+"""
+IMU calibration for Kevinbot v3
+Measures MPU9250 gyro/accel/mag biases and scale factors and persists them per sensor address
+"""
+
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+
+from mpu9250_fifo import GRAVITY
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+PARTS = ("gyro", "accel", "mag")
+ACCEL_POSITIONS = ("+X up", "-X up", "+Y up", "-Y up", "+Z up", "-Z up")
+
+PromptFunction = Callable[[str], None]
+
+
+class CalibrationError(Exception):
+    pass
+
+
+def calibration_path(mpu_settings: dict) -> str:
+    """The calibration file from settings, relative to the install rather than the working directory"""
+    return os.path.join(CURRENT_DIR, mpu_settings.get("calibration-file", "calibration/imu.json"))
+
+
+@dataclass
+class IMUCalibration:
+    """
+    Corrections in imusensor's convention:
+    accel = (raw - accel_bias) * accel_scale, gyro = raw - gyro_bias,
+    mag = (raw - mag_bias) * mag_scale, or (raw - mag_bias) @ mag_transform when present
+    """
+    gyro_bias: List[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+    accel_bias: List[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+    accel_scale: List[float] = field(default_factory=lambda: [1.0, 1.0, 1.0])
+    mag_bias: List[float] = field(default_factory=lambda: [0.0, 0.0, 0.0])
+    mag_scale: List[float] = field(default_factory=lambda: [1.0, 1.0, 1.0])
+    mag_transform: Optional[List[List[float]]] = None
+    calibrated: List[str] = field(default_factory=list)
+    updated: float = 0.0
+
+    @classmethod
+    def from_imu(cls, imu):
+        transform = getattr(imu, "Magtransform", None)
+        return cls(gyro_bias=np.asarray(imu.GyroBias, dtype=np.float64).tolist(),
+                   accel_bias=np.asarray(imu.AccelBias, dtype=np.float64).tolist(),
+                   accel_scale=np.asarray(imu.Accels, dtype=np.float64).tolist(),
+                   mag_bias=np.asarray(imu.MagBias, dtype=np.float64).tolist(),
+                   mag_scale=np.asarray(imu.Mags, dtype=np.float64).tolist(),
+                   mag_transform=None if transform is None else np.asarray(transform, dtype=np.float64).tolist())
+
+    @classmethod
+    def from_dict(cls, values: dict):
+        known = {name: values[name] for name in cls.__dataclass_fields__ if name in values}
+        return cls(**known)
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def apply(self, imu):
+        imu.GyroBias = np.array(self.gyro_bias)
+        imu.AccelBias = np.array(self.accel_bias)
+        imu.Accels = np.array(self.accel_scale)
+        imu.MagBias = np.array(self.mag_bias)
+        imu.Mags = np.array(self.mag_scale)
+        imu.Magtransform = None if self.mag_transform is None else np.array(self.mag_transform)
+
+    def correct(self, accel: np.ndarray, gyro: np.ndarray):
+        """Calibrate (N, 3) accel and gyro batches that bypass imusensor, e.g. from the FIFO"""
+        return ((accel - np.asarray(self.accel_bias)) * np.asarray(self.accel_scale),
+                gyro - np.asarray(self.gyro_bias))
+
+
+def _key(address: int) -> str:
+    return f"0x{address:02x}"
+
+
+def _load_file(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_calibration(path: str, address: int) -> Optional[IMUCalibration]:
+    try:
+        values = _load_file(path).get(_key(address))
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read IMU calibration from {path}: {e}")
+        return None
+    if values is None:
+        return None
+    return IMUCalibration.from_dict(values)
+
+
+def save_calibration(path: str, address: int, calibration: IMUCalibration):
+    try:
+        calibrations = _load_file(path)
+    except ValueError:
+        logging.warning(f"Replacing unreadable IMU calibration file {path}")
+        calibrations = {}
+    calibrations[_key(address)] = calibration.as_dict()
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # write then rename so a crash mid-save never leaves a truncated file behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(calibrations, f, indent=4)
+    os.replace(temp_path, path)
+
+
+def begin(imu, calibration: Optional[IMUCalibration]) -> IMUCalibration:
+    """
+    Start the IMU. imusensor's begin() ends with a 2s still-robot gyro calibration,
+    which is skipped when a saved calibration is loaded.
+    """
+    if calibration is None or "gyro" not in calibration.calibrated:
+        imu.begin()
+        if calibration is None:
+            return IMUCalibration.from_imu(imu)
+        calibration.gyro_bias = np.asarray(imu.GyroBias, dtype=np.float64).tolist()
+    else:
+        imu.caliberateGyro = lambda: None
+        try:
+            imu.begin()
+        finally:
+            del imu.caliberateGyro
+    calibration.apply(imu)
+    return calibration
+
+
+def _collect(imu, attribute: str, samples: int, interval: float) -> np.ndarray:
+    values = np.empty((samples, 3))
+    for index in range(samples):
+        imu.readSensor()
+        values[index] = getattr(imu, attribute)
+        time.sleep(interval)
+    return values
+
+
+def calibrate_gyro(imu, calibration: IMUCalibration, samples: int = 200, interval: float = 0.005,
+                   max_noise: float = 0.05):
+    imu.GyroBias = np.zeros(3)
+    values = _collect(imu, "GyroVals", samples, interval)
+    noise = float(values.std(axis=0).max())
+    if noise > max_noise:
+        raise CalibrationError(f"Gyro moved during calibration (noise {noise:.3f} rad/s), keep the robot still")
+    calibration.gyro_bias = values.mean(axis=0).tolist()
+
+
+def calibrate_accel(imu, calibration: IMUCalibration, prompt: PromptFunction, samples: int = 100,
+                    interval: float = 0.01):
+    imu.AccelBias = np.zeros(3)
+    imu.Accels = np.ones(3)
+    means = []
+    for position in ACCEL_POSITIONS:
+        prompt(f"Place the IMU {position}")
+        means.append(_collect(imu, "AccelVals", samples, interval).mean(axis=0))
+    means = np.array(means)
+
+    # each axis sees +g in one position and -g in another
+    high = means.max(axis=0)
+    low = means.min(axis=0)
+    if np.any(high < GRAVITY / 2) or np.any(low > -GRAVITY / 2):
+        raise CalibrationError("Accelerometer never saw ±g on every axis, check the six positions")
+    calibration.accel_bias = ((high + low) / 2).tolist()
+    calibration.accel_scale = (2 * GRAVITY / (high - low)).tolist()
+
+
+def calibrate_mag(imu, calibration: IMUCalibration, prompt: PromptFunction, duration: float = 20.0,
+                  interval: float = 0.02):
+    imu.MagBias = np.zeros(3)
+    imu.Mags = np.ones(3)
+    imu.Magtransform = None
+    prompt(f"Rotate the IMU in a figure 8 through every orientation for {duration:g}s")
+    values = _collect(imu, "MagVals", max(1, int(duration / interval)), interval)
+
+    # hard iron offset is the centre of the readings, soft iron is approximated per axis
+    low, high = values.min(axis=0), values.max(axis=0)
+    radii = (high - low) / 2
+    if np.any(radii <= 0):
+        raise CalibrationError("Magnetometer readings did not change, rotate the IMU during calibration")
+    calibration.mag_bias = ((high + low) / 2).tolist()
+    calibration.mag_scale = (radii.mean() / radii).tolist()
+    calibration.mag_transform = None
+
+
+def calibrate(imu, calibration: IMUCalibration, parts: Iterable[str], prompt: PromptFunction) -> IMUCalibration:
+    """Run the requested calibrations, a failed part raises CalibrationError and keeps its previous values"""
+    for part in parts:
+        if part not in PARTS:
+            raise ValueError(f"Unknown calibration {part}, available: {', '.join(PARTS)}")
+        logging.info(f"Calibrating {part}")
+        try:
+            if part == "gyro":
+                prompt("Keep the robot still")
+                calibrate_gyro(imu, calibration)
+            elif part == "accel":
+                calibrate_accel(imu, calibration, prompt)
+            else:
+                calibrate_mag(imu, calibration, prompt)
+        finally:
+            # the routines read uncorrected values, restore the corrections either way
+            calibration.apply(imu)
+        if part not in calibration.calibrated:
+            calibration.calibrated.append(part)
+    calibration.updated = time.time()
+    return calibration
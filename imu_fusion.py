@@ -0,0 +1,209 @@
+"""
+IMU sensor fusion for Kevinbot v3
+Madgwick and Mahony AHRS filters that consume batches of gyro/accel/mag samples
+"""
+
+import math
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def _prepare(values, count: int) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64).reshape(count, 3)
+    norms = np.linalg.norm(values, axis=1, keepdims=True)
+    # zero-length vectors stay zero so the filter can skip them
+    return np.divide(values, norms, out=np.zeros_like(values), where=norms > 0)
+
+
+class FusionEngine(ABC):
+    def __init__(self, sample_period: float):
+        self.sample_period = sample_period
+        self.quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+
+    def reset(self):
+        self.quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+
+    def update_batch(self, gyro, accel, mag=None, dt=None, history: bool = False) -> np.ndarray:
+        """
+        Run the filter over N samples, gyro in rad/s (N, 3), accel and mag in any unit (N, 3).
+        dt is an optional (N,) array of sample intervals, sample_period is used otherwise.
+        Returns the final quaternion, or the (N, 4) quaternion after every sample with history.
+        """
+        gyro = np.asarray(gyro, dtype=np.float64).reshape(-1, 3)
+        count = len(gyro)
+        if not count:
+            return np.empty((0, 4)) if history else self.quaternion
+
+        # normalisation and dt expansion are done for the whole batch up front, the
+        # recursive part then runs on plain floats which beats per-sample NumPy calls
+        accel = _prepare(accel, count)
+        mag = np.zeros((count, 3)) if mag is None else _prepare(mag, count)
+        if dt is None:
+            dt = np.full(count, self.sample_period)
+        else:
+            dt = np.broadcast_to(np.asarray(dt, dtype=np.float64), (count,))
+
+        out = [] if history else None
+        q = self._run(self.quaternion.tolist(), gyro.tolist(), accel.tolist(), mag.tolist(), dt.tolist(), out)
+        self.quaternion = np.array(q)
+        return np.array(out) if history else self.quaternion
+
+    @abstractmethod
+    def _run(self, q, gyro, accel, mag, dt, out):
+        """Filter the samples starting from quaternion q, appending each step to out unless it is None"""
+
+    def euler(self) -> Tuple[float, float, float]:
+        """Roll, pitch and yaw in degrees"""
+        roll, pitch, yaw = euler_batch(self.quaternion[np.newaxis])[0].tolist()
+        return roll, pitch, yaw
+
+
+def euler_batch(quaternions: np.ndarray) -> np.ndarray:
+    """(N, 4) quaternions to (N, 3) roll, pitch, yaw in degrees"""
+    q0, q1, q2, q3 = np.asarray(quaternions, dtype=np.float64).T
+    roll = np.arctan2(2 * (q0 * q1 + q2 * q3), 1 - 2 * (q1 * q1 + q2 * q2))
+    pitch = np.arcsin(np.clip(2 * (q0 * q2 - q3 * q1), -1.0, 1.0))
+    yaw = np.arctan2(2 * (q0 * q3 + q1 * q2), 1 - 2 * (q2 * q2 + q3 * q3))
+    return np.degrees(np.stack([roll, pitch, yaw], axis=-1))
+
+
+class MadgwickFusion(FusionEngine):
+    def __init__(self, sample_period: float, beta: float = 0.1):
+        super().__init__(sample_period)
+        self.beta = beta
+
+    def _run(self, q, gyro, accel, mag, dt, out):
+        q0, q1, q2, q3 = q
+        beta = self.beta
+        for (gx, gy, gz), (ax, ay, az), (mx, my, mz), step in zip(gyro, accel, mag, dt):
+            qdot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+            qdot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+            qdot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+            qdot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+            if ax or ay or az:
+                if mx or my or mz:
+                    # reference direction of earth's magnetic field
+                    hx = 2 * (mx * (0.5 - q2 * q2 - q3 * q3) + my * (q1 * q2 - q0 * q3) + mz * (q1 * q3 + q0 * q2))
+                    hy = 2 * (mx * (q1 * q2 + q0 * q3) + my * (0.5 - q1 * q1 - q3 * q3) + mz * (q2 * q3 - q0 * q1))
+                    bx = math.sqrt(hx * hx + hy * hy)
+                    bz = 2 * (mx * (q1 * q3 - q0 * q2) + my * (q2 * q3 + q0 * q1) + mz * (0.5 - q1 * q1 - q2 * q2))
+
+                    # objective function
+                    f1 = 2 * (q1 * q3 - q0 * q2) - ax
+                    f2 = 2 * (q0 * q1 + q2 * q3) - ay
+                    f3 = 2 * (0.5 - q1 * q1 - q2 * q2) - az
+                    f4 = 2 * bx * (0.5 - q2 * q2 - q3 * q3) + 2 * bz * (q1 * q3 - q0 * q2) - mx
+                    f5 = 2 * bx * (q1 * q2 - q0 * q3) + 2 * bz * (q0 * q1 + q2 * q3) - my
+                    f6 = 2 * bx * (q0 * q2 + q1 * q3) + 2 * bz * (0.5 - q1 * q1 - q2 * q2) - mz
+
+                    # gradient (jacobian transpose times objective)
+                    s0 = (-2 * q2 * f1 + 2 * q1 * f2 - 2 * bz * q2 * f4
+                          + (-2 * bx * q3 + 2 * bz * q1) * f5 + 2 * bx * q2 * f6)
+                    s1 = (2 * q3 * f1 + 2 * q0 * f2 - 4 * q1 * f3 + 2 * bz * q3 * f4
+                          + (2 * bx * q2 + 2 * bz * q0) * f5 + (2 * bx * q3 - 4 * bz * q1) * f6)
+                    s2 = (-2 * q0 * f1 + 2 * q3 * f2 - 4 * q2 * f3 + (-4 * bx * q2 - 2 * bz * q0) * f4
+                          + (2 * bx * q1 + 2 * bz * q3) * f5 + (2 * bx * q0 - 4 * bz * q2) * f6)
+                    s3 = (2 * q1 * f1 + 2 * q2 * f2 + (-4 * bx * q3 + 2 * bz * q1) * f4
+                          + (-2 * bx * q0 + 2 * bz * q2) * f5 + 2 * bx * q1 * f6)
+                else:
+                    f1 = 2 * (q1 * q3 - q0 * q2) - ax
+                    f2 = 2 * (q0 * q1 + q2 * q3) - ay
+                    f3 = 2 * (0.5 - q1 * q1 - q2 * q2) - az
+                    s0 = -2 * q2 * f1 + 2 * q1 * f2
+                    s1 = 2 * q3 * f1 + 2 * q0 * f2 - 4 * q1 * f3
+                    s2 = -2 * q0 * f1 + 2 * q3 * f2 - 4 * q2 * f3
+                    s3 = 2 * q1 * f1 + 2 * q2 * f2
+
+                norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+                if norm:
+                    qdot0 -= beta * s0 / norm
+                    qdot1 -= beta * s1 / norm
+                    qdot2 -= beta * s2 / norm
+                    qdot3 -= beta * s3 / norm
+
+            q0 += qdot0 * step
+            q1 += qdot1 * step
+            q2 += qdot2 * step
+            q3 += qdot3 * step
+            norm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            q0, q1, q2, q3 = q0 / norm, q1 / norm, q2 / norm, q3 / norm
+            if out is not None:
+                out.append((q0, q1, q2, q3))
+        return q0, q1, q2, q3
+
+
+class MahonyFusion(FusionEngine):
+    def __init__(self, sample_period: float, kp: float = 1.0, ki: float = 0.0):
+        super().__init__(sample_period)
+        self.kp = kp
+        self.ki = ki
+        self.integral = [0.0, 0.0, 0.0]
+
+    def reset(self):
+        super().reset()
+        self.integral = [0.0, 0.0, 0.0]
+
+    def _run(self, q, gyro, accel, mag, dt, out):
+        q0, q1, q2, q3 = q
+        ix, iy, iz = self.integral
+        kp, ki = self.kp, self.ki
+        for (gx, gy, gz), (ax, ay, az), (mx, my, mz), step in zip(gyro, accel, mag, dt):
+            if ax or ay or az:
+                # estimated direction of gravity
+                vx = 2 * (q1 * q3 - q0 * q2)
+                vy = 2 * (q0 * q1 + q2 * q3)
+                vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+                ex = ay * vz - az * vy
+                ey = az * vx - ax * vz
+                ez = ax * vy - ay * vx
+
+                if mx or my or mz:
+                    hx = 2 * (mx * (0.5 - q2 * q2 - q3 * q3) + my * (q1 * q2 - q0 * q3) + mz * (q1 * q3 + q0 * q2))
+                    hy = 2 * (mx * (q1 * q2 + q0 * q3) + my * (0.5 - q1 * q1 - q3 * q3) + mz * (q2 * q3 - q0 * q1))
+                    bx = math.sqrt(hx * hx + hy * hy)
+                    bz = 2 * (mx * (q1 * q3 - q0 * q2) + my * (q2 * q3 + q0 * q1) + mz * (0.5 - q1 * q1 - q2 * q2))
+                    # estimated direction of magnetic field
+                    wx = 2 * (bx * (0.5 - q2 * q2 - q3 * q3) + bz * (q1 * q3 - q0 * q2))
+                    wy = 2 * (bx * (q1 * q2 - q0 * q3) + bz * (q0 * q1 + q2 * q3))
+                    wz = 2 * (bx * (q0 * q2 + q1 * q3) + bz * (0.5 - q1 * q1 - q2 * q2))
+                    ex += my * wz - mz * wy
+                    ey += mz * wx - mx * wz
+                    ez += mx * wy - my * wx
+
+                if ki > 0:
+                    ix += ki * ex * step
+                    iy += ki * ey * step
+                    iz += ki * ez * step
+                    gx += ix
+                    gy += iy
+                    gz += iz
+                gx += kp * ex
+                gy += kp * ey
+                gz += kp * ez
+
+            half = 0.5 * step
+            gx, gy, gz = gx * half, gy * half, gz * half
+            q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                              q1 + q0 * gx + q2 * gz - q3 * gy,
+                              q2 + q0 * gy - q1 * gz + q3 * gx,
+                              q3 + q0 * gz + q1 * gy - q2 * gx)
+            norm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            q0, q1, q2, q3 = q0 / norm, q1 / norm, q2 / norm, q3 / norm
+            if out is not None:
+                out.append((q0, q1, q2, q3))
+        self.integral = [ix, iy, iz]
+        return q0, q1, q2, q3
+
+
+def create_fusion(fusion_settings: dict, sample_period: float) -> Optional[FusionEngine]:
+    algorithm = fusion_settings.get("algorithm", "none").lower()
+    if algorithm == "madgwick":
+        return MadgwickFusion(sample_period, beta=fusion_settings.get("beta", 0.1))
+    elif algorithm == "mahony":
+        return MahonyFusion(sample_period, kp=fusion_settings.get("kp", 1.0), ki=fusion_settings.get("ki", 0.0))
+    elif algorithm == "none":
+        return None
+    raise ValueError(f"Unknown fusion algorithm {algorithm}")
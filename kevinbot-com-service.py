@@ -1,10 +1,11 @@
 import logging
 import traceback
-from typing import Any, Final, List
-from dataclasses import dataclass
+from typing import Any, Final, List, Optional
+from dataclasses import asdict, dataclass
 from dataclasses import field as dataclass_field
 
 import datetime
+import json
 import os
 import time
 import subprocess
@@ -21,6 +22,12 @@ from paho.mqtt import client as mqtt_client
 
 from xbee import XBee
 
+import procfs
+from battery_history import BatteryHistory
+from battery_monitor import BatteryMonitor, BatteryState
+from mqtt_publisher import QueuedPublisher
+from scheduler import MissPolicy, Scheduler
+
 from system_options import (
     settings,
     TOPIC_HUMI,
@@ -35,8 +42,6 @@ from system_options import (
     P2_BAUD_RATE,
     XB_BAUD_RATE,
     HEAD_BAUD_RATE,
-    BATT_LOW_VOLT,
-    USING_BATT_2,
     BROKER,
     PORT)
 
@@ -54,8 +59,10 @@ class CurrentStateManager:
     core_alive: bool = True
     core_uptime: int = 0
     core_uptime_ms: int = 0
-    battery_notifications_displayed: list[bool] = dataclass_field(default_factory=lambda: [False, False])
     connected_remotes: list[str] = dataclass_field(default_factory=list)
+    remotes_last_seen: dict[str, float] = dataclass_field(default_factory=dict)
+    # XBee source address of each remote, so any frame from it counts as a sign of life
+    remote_addresses: dict[bytes, str] = dataclass_field(default_factory=dict)
     sensors: dict = dataclass_field(default_factory=lambda: {
         "batts": [-1, -1],
         "mpu": [0, 0, 0],
@@ -77,13 +84,6 @@ def speak_festival(text):
                                                                "Kevinbought")))
 
 
-def get_uptime():
-    with open('/proc/uptime', 'r') as f:
-        uptime_seconds = float(f.readline().split()[0])
-
-    return uptime_seconds
-
-
 def data_to_remote(data: str):
     xbee.send("tx", dest_addr=b'\x00\x00',
               data=bytes("{}".format(data), 'utf-8'))
@@ -116,33 +116,13 @@ def recv_loop():
 
             current_state.sensors["batts"][0] = float(line[1][0]) / 10
             current_state.sensors["batts"][1] = float(line[1][1]) / 10
-            if client:
-                client.publish(
-                    settings["services"]["com"]["topic-batt1"],
+            publish(settings["services"]["com"]["topic-batt1"],
                     current_state.sensors["batts"][0])
-                client.publish(
-                    settings["services"]["com"]["topic-batt2"],
+            publish(settings["services"]["com"]["topic-batt2"],
                     current_state.sensors["batts"][1])
 
-            if int(line[1][0]) < BATT_LOW_VOLT:
-                playsound.playsound(os.path.join(os.curdir,
-                                                 "sounds/low-battery.mp3"), False)
-                if not current_state.battery_notifications_displayed[0]:
-                    subprocess.run(["notify-send", "Kevinbot System",
-                                    f"Battery #1 is critically low. \
-                                    \nVoltage: {float(line[1][0]) / 10}V",
-                                    "-u", "critical", "-t", "0"])
-                    current_state.battery_notifications_displayed[0] = True
-
-            if int(line[1][1]) < BATT_LOW_VOLT and USING_BATT_2:
-                playsound.playsound(os.path.join(os.curdir,
-                                                 "sounds/low-battery.mp3"), block=False)
-                if not current_state.battery_notifications_displayed[1]:
-                    subprocess.run(["notify-send", "Kevinbot System",
-                                    f"Battery #2 is critically low. \
-                                    \nVoltage: {float(line[1][1]) / 10}V",
-                                    "-u", "critical", "-t", "0"])
-                    current_state.battery_notifications_displayed[1] = True
+            battery_monitor.update(current_state.sensors["batts"])
+            battery_history.append(current_state.sensors["batts"])
 
             data_to_remote(data)
         elif line[0] == "system.enable":
@@ -167,6 +147,26 @@ def recv_loop():
         # TODO: Re-tx data to remote
 
 
+def on_battery_transition(pack: int, old: BatteryState, new: BatteryState, voltage: float):
+    logger.info(f"Battery #{pack + 1} state {old.name} -> {new.name} ({voltage:.2f}V)")
+    if new <= old or new == BatteryState.OK:
+        return
+
+    playsound.playsound(os.path.join(os.curdir,
+                                     "sounds/low-battery.mp3"), False)
+    if new == BatteryState.WARN:
+        message, urgency = "is low", "normal"
+    elif new == BatteryState.CRITICAL:
+        message, urgency = "is critically low", "critical"
+    else:
+        message, urgency = "has reached cutoff voltage", "critical"
+
+    subprocess.run(["notify-send", "Kevinbot System",
+                    f"Battery #{pack + 1} {message}. \
+                    \nVoltage: {round(voltage, 2)}V",
+                    "-u", urgency, "-t", "0"])
+
+
 def head_recv_loop():
     while True:
         data = head_ser.readline().decode("UTF-8")
@@ -175,11 +175,21 @@ def head_recv_loop():
 
 
 def tick():
-    data_to_remote(f"os_uptime={round(get_uptime())}")
+    data_to_remote(f"os_uptime={round(procfs.uptime())}")
     p2_ser.write("system.tick\n".encode("utf-8"))
-    publish(settings["services"]["com"]["topic-sys-uptime"], get_uptime())
+
+
+def publish_state():
+    publish(settings["services"]["com"]["topic-sys-uptime"], procfs.uptime())
     publish(settings["services"]["com"]["topic-enabled"], current_state.enabled)
 
+    thermal = procfs.thermal_zones()
+    if thermal:
+        publish(settings["services"]["com"]["topic-sys-thermal"], json.dumps(thermal))
+    throttle = procfs.throttled()
+    if throttle:
+        publish(settings["services"]["com"]["topic-sys-throttled"], json.dumps(asdict(throttle)))
+
 
 def begin_remote_handshake(uid: str):
     logger.info(f"Remote ({uid}) handshake started")
@@ -194,6 +204,8 @@ def begin_remote_handshake(uid: str):
 def e_stop(power_off: bool = False):
     data_to_core("system.estop\n")
     data_to_remote("system.estop")
+    # other services (e.g. the streamer's recorder) react to the estop time
+    publisher.publish(settings["services"]["com"]["topic-estop"], json.dumps({"t": time.time()}), qos=1)
     request_system_enable(False)
     if power_off:
         time.sleep(1)
@@ -247,6 +259,11 @@ def remote_recv_loop():
             if data["id"] == "status":
                 logger.warning("Got XBee Status msg: %s", data["status"])
 
+            source = data.get("source_addr")
+            remote = current_state.remote_addresses.get(source)
+            if remote in current_state.remotes_last_seen:
+                current_state.remotes_last_seen[remote] = time.monotonic()
+
             raw = data['rf_data'].decode().strip("\r\n")
             data = data['rf_data'].decode().strip("\r\n").split('=', 1)
 
@@ -275,12 +292,17 @@ def remote_recv_loop():
                 enabled = data[1].lower() in ["true", "t"]
                 request_system_enable(enabled)
             elif data[0] == "core.remotes.add":
+                current_state.remotes_last_seen[data[1]] = time.monotonic()
+                if source is not None:
+                    current_state.remote_addresses[source] = data[1]
                 if not data[1] in current_state.connected_remotes:
                     current_state.connected_remotes.append(data[1])
                     logger.info(f"Wireless device connected: {data[1]}")
                     logger.info(f"Total devices: {current_state.connected_remotes}")
                 begin_remote_handshake(data[1].split("|")[0])
             elif data[0] == "core.remotes.remove":
+                current_state.remotes_last_seen.pop(data[1], None)
+                current_state.remote_addresses.pop(source, None)
                 if data[1] in current_state.connected_remotes:
                     current_state.connected_remotes.remove(data[1])
                     logger.info(f"Wireless device disconnected: {data[1]}")
@@ -340,20 +362,61 @@ def on_message(cli, userdata, msg):
 
 
 def publish(topic, msg):
-    result = client.publish(topic, msg)
-    status = result[0]
-    if status != 0:
-        logger.error(f"Failed to send message to topic {topic}")
+    publisher.publish(topic, msg)
+
+
+def parse_period(value: str) -> Optional[float]:
+    value = str(value).lower().strip()
+    if value == "core":
+        return None
+    return float(value.rstrip("s"))
 
 
-def tick_loop():
-    if settings["services"]["com"]["tick"].lower() == "core":
+def publish_battery_stats():
+    estimates = battery_history.estimate()
+    if not estimates:
         return
 
-    while True:
-        time.sleep(float(settings["services"]["com"]
-                         ["tick"].lower().strip("s")))
-        tick()
+    publish(settings["services"]["com"]["topic-batt-stats"], json.dumps({
+        "voltage": [e.voltage for e in estimates],
+        "soc": [e.soc for e in estimates],
+        "rate": [round(e.rate, 4) for e in estimates],
+        "runtime": [None if e.runtime is None else round(e.runtime) for e in estimates]
+    }))
+
+
+def flush_metrics():
+    publish_battery_stats()
+    publish(settings["services"]["com"]["topic-sched-stats"], json.dumps(job_scheduler.stats()))
+    publish(settings["services"]["com"]["topic-mqtt-stats"], json.dumps(publisher.metrics()))
+
+
+def expire_remotes():
+    timeout = settings["services"]["com"]["remote-timeout"]
+    now = time.monotonic()
+    for remote, last_seen in list(current_state.remotes_last_seen.items()):
+        if now - last_seen < timeout:
+            continue
+        current_state.remotes_last_seen.pop(remote, None)
+        for address in [address for address, name in current_state.remote_addresses.items() if name == remote]:
+            current_state.remote_addresses.pop(address)
+        if remote in current_state.connected_remotes:
+            current_state.connected_remotes.remove(remote)
+            logger.warning(f"Wireless device timed out: {remote}")
+            logger.info(f"Total devices: {current_state.connected_remotes}")
+            transmit_full_remote_list()
+
+
+def schedule_jobs():
+    com_settings = settings["services"]["com"]
+
+    tick_period = parse_period(com_settings["tick"])
+    if tick_period:
+        job_scheduler.add_job("tick", tick_period, tick, MissPolicy.CATCH_UP, max_catch_up=2)
+    job_scheduler.add_job("state", com_settings["state-interval"], publish_state)
+    job_scheduler.add_job("metrics", com_settings["metrics-interval"], flush_metrics)
+    if com_settings["remote-timeout"] > 0:
+        job_scheduler.add_job("remote-expiry", com_settings["remote-timeout"] / 2, expire_remotes)
 
 
 def perform_core_handshake():
@@ -367,8 +430,8 @@ def perform_core_handshake():
             p2_ser.write("core.errors.clear\n".encode("utf-8"))
             p2_ser.write("connection.ok\n".encode("utf-8"))
             logger.success("Core is connected")
-            logger.info("Reset battery notifications")
-            current_state.battery_notifications_displayed = [False, False]
+            logger.info("Reset battery monitor")
+            battery_monitor.reset()
             break
         time.sleep(0.1)
 
@@ -386,6 +449,8 @@ if __name__ == "__main__":
     print("\033[0m", end=None)
 
     current_state = CurrentStateManager()
+    battery_monitor = BatteryMonitor.from_settings(settings["battery"], on_battery_transition)
+    battery_history = BatteryHistory.from_settings(settings["battery"])
 
     # logging
     logger.remove()
@@ -408,12 +473,15 @@ if __name__ == "__main__":
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(BROKER, PORT)
-    client.subscribe(TOPIC_ROLL)
-    client.subscribe(TOPIC_PITCH)
-    client.subscribe(TOPIC_YAW)
-    client.subscribe(TOPIC_TEMP)
-    client.subscribe(TOPIC_HUMI)
-    client.subscribe(TOPIC_PRESSURE)
+    # set sensor-topic-suffix to forward a decimated sensor stream instead of the base topics
+    sensor_suffix = settings["services"]["com"].get("sensor-topic-suffix", "")
+    for topic in (TOPIC_ROLL, TOPIC_PITCH, TOPIC_YAW, TOPIC_TEMP, TOPIC_HUMI, TOPIC_PRESSURE):
+        client.subscribe(topic + sensor_suffix)
+
+    publisher = QueuedPublisher(client,
+                                max_queue=settings["services"]["mqtt"]["max-queue"],
+                                max_inflight=settings["services"]["mqtt"]["max-inflight"])
+    publisher.start()
 
     # hold up until core is ready
     logger.info("Waiting for core connection")
@@ -430,8 +498,9 @@ if __name__ == "__main__":
     remote_recv_thread = threading.Thread(target=remote_recv_loop, daemon=True)
     remote_recv_thread.start()
 
-    tick_thread = threading.Thread(target=tick_loop, daemon=True)
-    tick_thread.start()
+    job_scheduler = Scheduler()
+    schedule_jobs()
+    job_scheduler.start()
 
     # init
     data_to_remote("core.service.init=kevinbot.com")
@@ -0,0 +1,15 @@
+"""
+Kevinbot v3 Sensors-2-MQTT
+Hosts every sensor driver in one process with a shared scheduler, MQTT connection and I2C bus
+"""
+
+import logging
+
+from system_options import settings
+from sensor_host import SensorHost
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=settings["logging"]["level"])
+
+    SensorHost(settings, settings["services"]["sensors"]["drivers"]).run()
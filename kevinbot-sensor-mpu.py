@@ -3,72 +3,52 @@ Kevinbot v3 MPU9250-2-MQTT
 By: Kevin Ahr
 """
 
-import sys
 import os
-import time
-import smbus
-import uuid
 import json
+import argparse
 import logging
 
-from paho.mqtt import client as mqtt_client
-
-from imusensor.MPU9250 import MPU9250
+from imu_calibration import (PARTS, CalibrationError, begin, calibrate, calibration_path, load_calibration,
+                             save_calibration)
+from sensor_host import SensorHost, open_bus
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 SETTINGS_PATH = os.path.join(CURRENT_DIR, 'settings.json')
 
 settings = json.load(open(SETTINGS_PATH, 'r'))
 
-BROKER = settings["services"]["mqtt"]["address"]
-PORT = settings["services"]["mqtt"]["port"]
-TOPIC_ROLL = settings["services"]["mpu"]["topic-roll"]
-TOPIC_PITCH = settings["services"]["mpu"]["topic-pitch"]
-TOPIC_YAW = settings["services"]["mpu"]["topic-yaw"]
-CLI_ID = f'kevinbot-mpu-{uuid.uuid4()}'
-
-
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        logging.info("Connected to MQTT Broker")
-    else:
-        logging.critical("Failed to connect, return code %d\n", rc)
-        sys.exit()
-
 
-client = mqtt_client.Client(CLI_ID)
-client.on_connect = on_connect
-client.connect(BROKER, PORT)
+def run_calibration(parts):
+    from sensor_drivers import open_imu
 
+    mpu_settings = settings["services"]["mpu"]
+    address = int(mpu_settings["address"])
+    path = calibration_path(mpu_settings)
 
-def publish(topic, msg):
-    result = client.publish(topic, msg)
-    status = result[0]
-    if status != 0:
-        logging.error(f"Failed to send message to topic {topic}")
+    bus = None
+    if mpu_settings.get("backend", "hardware") == "hardware":
+        bus = open_bus(settings["services"].get("sensors", {}).get("bus", 1))
+    imu = open_imu(bus, mpu_settings)
+    calibration = begin(imu, load_calibration(path, address))
 
-
-def loop():
-    while True:
-        # read from sensor
-        imu.readSensor()
-        imu.computeOrientation()
-
-        # publish over mqtt
-        publish(TOPIC_ROLL, round(imu.roll, 2))
-        publish(TOPIC_PITCH, round(imu.pitch, 2))
-        publish(TOPIC_YAW, round(imu.yaw, 2))
-
-        # wait
-        time.sleep(settings["services"]["mpu"]["update-speed"])
+    try:
+        calibrate(imu, calibration, parts, lambda message: input(f"{message}, then press enter"))
+    except CalibrationError as e:
+        logging.error(f"Calibration failed: {e}")
+        return
+    save_calibration(path, address, calibration)
+    logging.info(f"Saved {', '.join(calibration.calibrated)} calibration for 0x{address:02x} to {path}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish MPU9250 orientation to MQTT")
+    parser.add_argument("--calibrate", nargs="*", metavar="SENSOR", choices=PARTS,
+                        help=f"calibrate and save, any of {', '.join(PARTS)} (default: all)")
+    args = parser.parse_args()
+
     logging.basicConfig(level=settings["logging"]["level"])
-    if settings["services"]["mpu"]["enabled"]:
-        bus = smbus.SMBus(1)
-        imu = MPU9250.MPU9250(bus, int(settings["services"]["mpu"]["address"]))
-        imu.begin()
-        loop()
+
+    if args.calibrate is not None:
+        run_calibration(args.calibrate or PARTS)
     else:
-        logging.warning("MPU Service is not enabled, exiting")
+        SensorHost(settings, ["mpu"], client_name="mpu").run()
@@ -0,0 +1,62 @@
+"""
+Kevinbot v3 sensor log replay
+Republishes recorded sensor logs to MQTT at original or accelerated speed
+"""
+
+import argparse
+import logging
+import time
+import uuid
+
+import numpy as np
+from paho.mqtt import client as mqtt_client
+
+from system_options import settings
+from sensor_recorder import SensorLog, read_segment, read_stream
+
+
+def replay(client: mqtt_client.Client, log: SensorLog, speed: float = 1.0, loop: bool = False):
+    if not len(log):
+        logging.warning(f"{log.stream} log is empty")
+        return
+
+    columns = [log.column(field).astype(np.float64) for field in log.fields]
+    offsets = log.playback_offsets()
+
+    while True:
+        start = time.monotonic()
+        for index, offset in enumerate(offsets.tolist()):
+            if speed > 0:
+                delay = start + offset / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            for topic, column in zip(log.topics, columns):
+                client.publish(topic, round(float(column[index]), 2))
+
+        logging.info(f"Replayed {len(log)} {log.stream} samples")
+        if not loop:
+            break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Republish a recorded sensor log to MQTT")
+    parser.add_argument("source", help="log segment (.kbsr) or log directory")
+    parser.add_argument("-s", "--stream", help="stream to replay when source is a directory, e.g. mpu")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed multiplier, 0 for no delay")
+    parser.add_argument("--loop", action="store_true", help="restart from the beginning when the log ends")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings["logging"]["level"])
+
+    if args.stream:
+        sensor_log = read_stream(args.source, args.stream)
+    else:
+        sensor_log = read_segment(args.source)
+
+    client = mqtt_client.Client(f'kevinbot-replay-{uuid.uuid4()}')
+    client.connect(settings["services"]["mqtt"]["address"], settings["services"]["mqtt"]["port"])
+    client.loop_start()
+    try:
+        replay(client, sensor_log, args.speed, args.loop)
+    finally:
+        client.loop_stop()
@@ -0,0 +1,163 @@
+"""
+MPU9250 FIFO acquisition for Kevinbot v3
+Lets the sensor sample at a fixed internal rate and drains accel/gyro packets from the FIFO in block reads
+"""
+
+import math
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+try:
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
+
+REG_SMPLRT_DIV = 0x19
+REG_CONFIG = 0x1A
+REG_GYRO_CONFIG = 0x1B
+REG_ACCEL_CONFIG = 0x1C
+REG_ACCEL_CONFIG2 = 0x1D
+REG_FIFO_EN = 0x23
+REG_INT_STATUS = 0x3A
+REG_USER_CTRL = 0x6A
+REG_PWR_MGMT_1 = 0x6B
+REG_FIFO_COUNTH = 0x72
+REG_FIFO_R_W = 0x74
+
+FIFO_EN_ACCEL_GYRO = 0x78
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_I2C_MST_EN = 0x20
+USER_CTRL_FIFO_RST = 0x04
+INT_STATUS_FIFO_OVERFLOW = 0x10
+
+FIFO_SIZE = 512
+PACKET_SIZE = 12  # accel xyz + gyro xyz, big-endian int16
+# largest multiple of PACKET_SIZE that fits in one SMBus block read
+SMBUS_CHUNK = 24
+
+GRAVITY = 9.80665
+ACCEL_RANGES = {2: 0, 4: 1, 8: 2, 16: 3}
+# same axes as imusensor's readSensor, which lines accel/gyro up with the magnetometer
+AXIS_ORDER = [1, 0, 2]
+AXIS_SIGN = np.array([1.0, 1.0, -1.0])
+GYRO_RANGES = {250: 0, 500: 1, 1000: 2, 2000: 3}
+
+
+@dataclass
+class FifoBatch:
+    timestamps: np.ndarray  # (N,) monotonic seconds
+    accel: np.ndarray  # (N, 3) m/s^2
+    gyro: np.ndarray  # (N, 3) rad/s
+    overflowed: bool = False
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class MPU9250Fifo:
+    def __init__(self, bus, address: int = 0x68, sample_rate: float = 200, dlpf: int = 2,
+                 accel_range: int = 4, gyro_range: int = 500):
+        if not 1 <= dlpf <= 6:
+            raise ValueError(f"DLPF setting must be 1-6 for a 1kHz internal rate, got {dlpf}")
+
+        self.bus = bus
+        self.address = address
+        self.divider = min(255, max(0, round(1000 / sample_rate) - 1))
+        self.sample_rate = 1000 / (1 + self.divider)
+        self.period = 1 / self.sample_rate
+        self.dlpf = dlpf
+        self.accel_scale = accel_range * GRAVITY / 32768
+        self.gyro_scale = math.radians(gyro_range) / 32768
+        self._accel_code = ACCEL_RANGES[accel_range]
+        self._gyro_code = GYRO_RANGES[gyro_range]
+
+        self.overflows = 0
+        self._samples = 0
+        self._base: Optional[float] = None
+        self._user_ctrl = 0x00
+        # smbus2 can read the whole FIFO in one I2C transaction
+        self._rdwr = i2c_msg is not None and hasattr(bus, "i2c_rdwr")
+
+    @classmethod
+    def from_settings(cls, bus, mpu_settings: dict):
+        fifo_settings = mpu_settings.get("fifo", {})
+        return cls(bus,
+                   address=int(mpu_settings["address"]),
+                   sample_rate=mpu_settings.get("sample-rate", fifo_settings.get("sample-rate", 200)),
+                   dlpf=fifo_settings.get("dlpf", 2),
+                   accel_range=fifo_settings.get("accel-range", 4),
+                   gyro_range=fifo_settings.get("gyro-range", 500))
+
+    def configure(self):
+        # keep the I2C master running so the magnetometer can still be read alongside the FIFO
+        self._user_ctrl = self.bus.read_byte_data(self.address, REG_USER_CTRL) & USER_CTRL_I2C_MST_EN
+        self.bus.write_byte_data(self.address, REG_PWR_MGMT_1, 0x01)
+        self.bus.write_byte_data(self.address, REG_USER_CTRL, self._user_ctrl)
+        self.bus.write_byte_data(self.address, REG_FIFO_EN, 0x00)
+        self.bus.write_byte_data(self.address, REG_SMPLRT_DIV, self.divider)
+        self.bus.write_byte_data(self.address, REG_CONFIG, self.dlpf)
+        self.bus.write_byte_data(self.address, REG_GYRO_CONFIG, self._gyro_code << 3)
+        self.bus.write_byte_data(self.address, REG_ACCEL_CONFIG, self._accel_code << 3)
+        self.bus.write_byte_data(self.address, REG_ACCEL_CONFIG2, self.dlpf)
+        self.reset()
+
+    def reset(self):
+        self.bus.write_byte_data(self.address, REG_USER_CTRL, self._user_ctrl | USER_CTRL_FIFO_RST)
+        self.bus.write_byte_data(self.address, REG_USER_CTRL, self._user_ctrl | USER_CTRL_FIFO_EN)
+        self.bus.write_byte_data(self.address, REG_FIFO_EN, FIFO_EN_ACCEL_GYRO)
+        self._samples = 0
+        self._base = time.monotonic()
+
+    @property
+    def fifo_duration(self) -> float:
+        """Seconds of data the FIFO holds before it overflows"""
+        return FIFO_SIZE // PACKET_SIZE * self.period
+
+    def fifo_count(self) -> int:
+        high, low = self.bus.read_i2c_block_data(self.address, REG_FIFO_COUNTH, 2)
+        return (high << 8) | low
+
+    def _read_fifo(self, length: int) -> bytes:
+        if self._rdwr:
+            write = i2c_msg.write(self.address, [REG_FIFO_R_W])
+            read = i2c_msg.read(self.address, length)
+            self.bus.i2c_rdwr(write, read)
+            return bytes(read)
+
+        # FIFO_R_W doesn't auto-increment, so consecutive block reads keep draining the FIFO
+        data = bytearray()
+        while len(data) < length:
+            data += bytes(self.bus.read_i2c_block_data(self.address, REG_FIFO_R_W,
+                                                       min(SMBUS_CHUNK, length - len(data))))
+        return bytes(data)
+
+    def drain(self) -> FifoBatch:
+        overflowed = bool(self.bus.read_byte_data(self.address, REG_INT_STATUS) & INT_STATUS_FIFO_OVERFLOW)
+        if overflowed:
+            # packets may be misaligned after an overflow, start clean
+            self.overflows += 1
+            self.reset()
+            return FifoBatch(np.empty(0), np.empty((0, 3)), np.empty((0, 3)), overflowed=True)
+
+        packets = self.fifo_count() // PACKET_SIZE
+        if not packets:
+            return FifoBatch(np.empty(0), np.empty((0, 3)), np.empty((0, 3)))
+
+        raw = np.frombuffer(self._read_fifo(packets * PACKET_SIZE), dtype=">i2").reshape(packets, 6)
+        now = time.monotonic()
+
+        # samples are spaced by the configured rate, the anchor only moves when the
+        # sensor oscillator has drifted far enough that stamps would land in the future
+        # or more than one FIFO's worth in the past
+        last = self._base + (self._samples + packets - 1) * self.period
+        if last > now or now - last > self.fifo_duration:
+            self._base = now - (self._samples + packets - 1) * self.period
+        timestamps = self._base + (self._samples + np.arange(packets)) * self.period
+        self._samples += packets
+
+        return FifoBatch(timestamps,
+                         raw[:, AXIS_ORDER] * (AXIS_SIGN * self.accel_scale),
+                         raw[:, 3:6][:, AXIS_ORDER] * (AXIS_SIGN * self.gyro_scale))
@@ -0,0 +1,180 @@
+"""
+Queued MQTT publisher for Kevinbot v3 services
+Bounded outbound queue with per-topic latest-value coalescing, an in-flight limit and delivery metrics
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, Optional, Set
+
+from loguru import logger
+from paho.mqtt import client as mqtt_client
+
+
+class TopicPolicy(Enum):
+    # only the newest pending value of a topic is sent
+    LATEST = "latest"
+    # every message is sent in order
+    FIFO = "fifo"
+
+
+@dataclass
+class _Pending:
+    topic: str
+    payload: Any
+    qos: int
+    retain: bool
+    enqueued: float
+
+
+@dataclass
+class PublisherMetrics:
+    queued: int = 0
+    published: int = 0
+    acked: int = 0
+    coalesced: int = 0
+    dropped: int = 0
+    failed: int = 0
+    latency_mean: float = 0.0
+    latency_max: float = 0.0
+
+
+class QueuedPublisher:
+    def __init__(self, client: mqtt_client.Client, max_queue: int = 256, max_inflight: int = 20,
+                 default_policy: TopicPolicy = TopicPolicy.LATEST, latency_alpha: float = 0.1,
+                 inflight_timeout: float = 10.0):
+        self.client = client
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.default_policy = default_policy
+        self.latency_alpha = latency_alpha
+        self.inflight_timeout = inflight_timeout
+
+        self._policies: Dict[str, TopicPolicy] = {}
+        self._pending: "OrderedDict[Any, _Pending]" = OrderedDict()
+        self._inflight: Dict[int, float] = {}
+        self._early_acks: Set[int] = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._metrics = PublisherMetrics()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+        client.max_inflight_messages_set(max_inflight)
+        client.on_publish = self._on_publish
+
+    def set_policy(self, topic: str, policy: TopicPolicy):
+        self._policies[topic] = policy
+
+    def publish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False):
+        """Queue a message, never blocks on the broker"""
+        policy = self._policies.get(topic, self.default_policy)
+        key = topic if policy == TopicPolicy.LATEST else (topic, next(self._seq))
+
+        with self._cond:
+            if key in self._pending:
+                # keep the queue position, replace the value
+                self._pending[key] = _Pending(topic, payload, qos, retain, self._pending[key].enqueued)
+                self._metrics.coalesced += 1
+            else:
+                if len(self._pending) >= self.max_queue:
+                    self._pending.popitem(last=False)
+                    self._metrics.dropped += 1
+                self._pending[key] = _Pending(topic, payload, qos, retain, time.monotonic())
+            self._metrics.queued += 1
+            self._cond.notify()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "inflight": len(self._inflight),
+                "queued": self._metrics.queued,
+                "published": self._metrics.published,
+                "acked": self._metrics.acked,
+                "coalesced": self._metrics.coalesced,
+                "dropped": self._metrics.dropped,
+                "failed": self._metrics.failed,
+                "latency_mean": round(self._metrics.latency_mean, 6),
+                "latency_max": round(self._metrics.latency_max, 6),
+            }
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._pending or len(self._inflight) >= self.max_inflight):
+                    self._cond.wait(1.0)
+                    self._expire_inflight()
+                if self._stopped:
+                    return
+                _, message = self._pending.popitem(last=False)
+
+            # publish outside the lock, paho may call on_publish from this thread
+            try:
+                result = self.client.publish(message.topic, message.payload, message.qos, message.retain)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Failed to send message to topic {message.topic}: {e!r}")
+                result = None
+
+            with self._cond:
+                if result is None or result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                    self._metrics.failed += 1
+                    if result is not None:
+                        logger.error(f"Failed to send message to topic {message.topic}, rc={result.rc}")
+                    continue
+
+                self._metrics.published += 1
+                if result.mid in self._early_acks:
+                    self._early_acks.discard(result.mid)
+                    self._record_ack(message.enqueued)
+                else:
+                    self._inflight[result.mid] = message.enqueued
+
+    def _expire_inflight(self):
+        # acks lost across a reconnect would otherwise hold their in-flight slot forever
+        deadline = time.monotonic() - self.inflight_timeout
+        for mid, enqueued in list(self._inflight.items()):
+            if enqueued < deadline:
+                del self._inflight[mid]
+                self._metrics.failed += 1
+        self._early_acks.clear()
+
+    def _on_publish(self, client, userdata, mid):
+        with self._cond:
+            enqueued = self._inflight.pop(mid, None)
+            if enqueued is None:
+                self._early_acks.add(mid)
+                return
+            self._record_ack(enqueued)
+            self._cond.notify()
+
+    def _record_ack(self, enqueued: float):
+        latency = time.monotonic() - enqueued
+        self._metrics.acked += 1
+        if self._metrics.acked == 1:
+            self._metrics.latency_mean = latency
+        else:
+            self._metrics.latency_mean += self.latency_alpha * (latency - self._metrics.latency_mean)
+        self._metrics.latency_max = max(self._metrics.latency_max, latency)
@@ -0,0 +1,138 @@
+"""
+Persistent procfs/sysfs readers for Kevinbot v3
+Files are opened once and re-read with pread, so polling them from every tick is cheap
+"""
+
+import functools
+import glob
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+class PersistentFile:
+    def __init__(self, path: str, size: int = 4096):
+        self.path = path
+        self.size = size
+        self._fd: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def read(self) -> str:
+        return self.read_bytes().decode("utf-8", errors="replace")
+
+    def read_bytes(self) -> bytes:
+        # pread always starts at offset 0, so the descriptor can be shared between threads
+        try:
+            return os.pread(self._open(), self.size, 0)
+        except OSError:
+            # sysfs nodes can disappear (hotplug, driver reload), reopen once
+            self.close()
+            return os.pread(self._open(), self.size, 0)
+
+    def _open(self) -> int:
+        fd = self._fd
+        if fd is None:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+                fd = self._fd
+        return fd
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                try:
+                    os.close(self._fd)
+                except OSError:
+                    pass
+                self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+_files: Dict[str, PersistentFile] = {}
+_files_lock = threading.Lock()
+
+
+def persistent(path: str) -> PersistentFile:
+    file = _files.get(path)
+    if file is None:
+        with _files_lock:
+            file = _files.setdefault(path, PersistentFile(path))
+    return file
+
+
+@functools.lru_cache(maxsize=None)
+def read_immutable(path: str, default: str = "") -> str:
+    try:
+        with open(path, "rb") as f:
+            return f.read().decode("utf-8", errors="replace").strip("\x00\n ")
+    except OSError:
+        return default
+
+
+def uptime() -> float:
+    return float(persistent("/proc/uptime").read().split()[0])
+
+
+def board_model() -> str:
+    return read_immutable("/proc/device-tree/model", "Unknown")
+
+
+@functools.lru_cache(maxsize=None)
+def _thermal_zone_paths() -> Dict[str, str]:
+    zones = {}
+    for zone in sorted(glob.glob("/sys/class/thermal/thermal_zone*")):
+        name = read_immutable(os.path.join(zone, "type"), os.path.basename(zone))
+        zones[name] = os.path.join(zone, "temp")
+    return zones
+
+
+def thermal_zones() -> Dict[str, float]:
+    """Temperature of every thermal zone in °C, keyed by zone type"""
+    temps = {}
+    for name, path in _thermal_zone_paths().items():
+        try:
+            temps[name] = int(persistent(path).read()) / 1000
+        except (OSError, ValueError):
+            continue
+    return temps
+
+
+@dataclass
+class ThrottleState:
+    raw: int
+    under_voltage: bool
+    freq_capped: bool
+    throttled: bool
+    soft_temp_limit: bool
+    under_voltage_occurred: bool
+    freq_capped_occurred: bool
+    throttled_occurred: bool
+    soft_temp_limit_occurred: bool
+
+    @classmethod
+    def from_raw(cls, raw: int):
+        return cls(raw,
+                   bool(raw & 0x1), bool(raw & 0x2), bool(raw & 0x4), bool(raw & 0x8),
+                   bool(raw & 0x10000), bool(raw & 0x20000), bool(raw & 0x40000), bool(raw & 0x80000))
+
+
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+
+@functools.lru_cache(maxsize=None)
+def _has_throttled() -> bool:
+    return os.path.exists(THROTTLED_PATH)
+
+
+def throttled() -> Optional[ThrottleState]:
+    """Raspberry Pi firmware throttle flags, None on boards without the firmware node"""
+    if not _has_throttled():
+        return None
+    try:
+        return ThrottleState.from_raw(int(persistent(THROTTLED_PATH).read().strip(), 16))
+    except (OSError, ValueError):
+        return None
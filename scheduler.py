@@ -0,0 +1,219 @@
+"""
+Periodic job scheduler for Kevinbot v3 services
+Runs jobs at independent rates off the monotonic clock so periods don't drift with job runtime
+"""
+
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Sequence
+
+from loguru import logger
+
+# bucket edges for lateness, in seconds
+DELAY_EDGES = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1.0)
+# bucket edges for start-to-start intervals, as a fraction of the job period
+PERIOD_EDGES = (0.5, 0.9, 0.98, 1.02, 1.1, 1.5, 2.0)
+
+
+class MissPolicy(Enum):
+    # run every missed period back-to-back (bounded by max_catch_up)
+    CATCH_UP = "catch_up"
+    # drop missed periods and realign to the next slot
+    SKIP = "skip"
+
+
+class Histogram:
+    """Counts per bucket between fixed edges, the first and last buckets are open ended"""
+
+    def __init__(self, edges: Sequence[float]):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_right(self.edges, value)] += 1
+
+    def as_dict(self, scale: float = 1.0) -> dict:
+        return {"edges": [round(edge * scale, 6) for edge in self.edges], "counts": list(self.counts)}
+
+
+@dataclass
+class JobStats:
+    runs: int = 0
+    skipped: int = 0
+    overruns: int = 0
+    jitter_min: float = float("inf")
+    jitter_max: float = 0.0
+    jitter_mean: float = 0.0
+    _jitter_m2: float = 0.0
+    runtime_last: float = 0.0
+    runtime_max: float = 0.0
+    first_start: Optional[float] = None
+    last_start: Optional[float] = None
+    jitter_hist: Histogram = dataclass_field(default_factory=lambda: Histogram(DELAY_EDGES))
+    period_hist: Histogram = dataclass_field(default_factory=lambda: Histogram(PERIOD_EDGES))
+    overrun_hist: Histogram = dataclass_field(default_factory=lambda: Histogram(DELAY_EDGES))
+
+    @property
+    def jitter_std(self) -> float:
+        return (self._jitter_m2 / self.runs) ** 0.5 if self.runs else 0.0
+
+    @property
+    def rate(self) -> float:
+        """Measured runs per second"""
+        if self.runs < 2 or self.last_start == self.first_start:
+            return 0.0
+        return (self.runs - 1) / (self.last_start - self.first_start)
+
+    def record_start(self, started: float, period: float):
+        if self.last_start is None:
+            self.first_start = started
+        else:
+            self.period_hist.add((started - self.last_start) / period)
+        self.last_start = started
+
+    def record_overrun(self, late: float):
+        self.overruns += 1
+        self.overrun_hist.add(late)
+
+    def record(self, jitter: float, runtime: float):
+        # Welford's running mean/variance
+        self.runs += 1
+        delta = jitter - self.jitter_mean
+        self.jitter_mean += delta / self.runs
+        self._jitter_m2 += delta * (jitter - self.jitter_mean)
+        self.jitter_min = min(self.jitter_min, jitter)
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.jitter_hist.add(jitter)
+        self.runtime_last = runtime
+        self.runtime_max = max(self.runtime_max, runtime)
+
+    def as_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "overruns": self.overruns,
+            "jitter_min": 0.0 if self.runs == 0 else round(self.jitter_min, 6),
+            "jitter_max": round(self.jitter_max, 6),
+            "jitter_mean": round(self.jitter_mean, 6),
+            "jitter_std": round(self.jitter_std, 6),
+            "runtime_last": round(self.runtime_last, 6),
+            "runtime_max": round(self.runtime_max, 6),
+            "rate": round(self.rate, 3),
+            # histogram edges in milliseconds, period edges as a fraction of the period
+            "jitter_hist": self.jitter_hist.as_dict(1000),
+            "period_hist": self.period_hist.as_dict(),
+            "overrun_hist": self.overrun_hist.as_dict(1000),
+        }
+
+
+@dataclass
+class PeriodicJob:
+    name: str
+    period: float
+    func: Callable[[], None]
+    policy: MissPolicy = MissPolicy.SKIP
+    max_catch_up: int = 5
+    next_due: float = 0.0
+    stats: JobStats = dataclass_field(default_factory=JobStats)
+
+
+class Scheduler:
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._jobs: Dict[str, PeriodicJob] = {}
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def add_job(self, name: str, period: float, func: Callable[[], None],
+                policy: MissPolicy = MissPolicy.SKIP, max_catch_up: int = 5,
+                delay: Optional[float] = None) -> PeriodicJob:
+        if period <= 0:
+            raise ValueError(f"Job {name} period must be positive, got {period}")
+
+        with self._lock:
+            if name in self._jobs:
+                raise ValueError(f"Job {name} is already scheduled")
+            job = PeriodicJob(name, period, func, policy, max_catch_up,
+                              next_due=self.clock() + (period if delay is None else delay))
+            self._jobs[name] = job
+            heapq.heappush(self._queue, (job.next_due, next(self._counter), job))
+        self._wake.set()
+        return job
+
+    def remove_job(self, name: str):
+        with self._lock:
+            job = self._jobs.pop(name, None)
+            if job:
+                self._queue = [entry for entry in self._queue if entry[2] is not job]
+                heapq.heapify(self._queue)
+
+    @property
+    def jobs(self) -> Dict[str, PeriodicJob]:
+        return dict(self._jobs)
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: job.stats.as_dict() for name, job in self._jobs.items()}
+
+    def run_pending(self) -> Optional[float]:
+        """Run every job that is due, return seconds until the next one (None when idle)"""
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return None
+                due, _, job = self._queue[0]
+                now = self.clock()
+                if due > now:
+                    return due - now
+                heapq.heappop(self._queue)
+
+            self._run_job(job, due, now)
+
+            with self._lock:
+                if self._jobs.get(job.name) is job:
+                    heapq.heappush(self._queue, (job.next_due, next(self._counter), job))
+
+    def _run_job(self, job: PeriodicJob, due: float, started: float):
+        job.stats.record_start(started, job.period)
+        try:
+            job.func()
+        except Exception as e:
+            logger.exception(f"Exception in scheduled job {job.name}: {e!r}")
+        finished = self.clock()
+        job.stats.record(started - due, finished - started)
+
+        job.next_due = due + job.period
+        if job.next_due > finished:
+            return
+
+        job.stats.record_overrun(finished - job.next_due)
+        missed = int((finished - job.next_due) // job.period) + 1
+        if job.policy == MissPolicy.CATCH_UP and missed <= job.max_catch_up:
+            # leave next_due in the past so the missed period runs immediately
+            return
+        job.stats.skipped += missed
+        job.next_due += missed * job.period
+
+    def run_forever(self):
+        while not self._stopped:
+            delay = self.run_pending()
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
@@ -0,0 +1,206 @@
+"""
+Kevinbot v3 sensor drivers
+BME280 and MPU9250 drivers for the sensor host
+"""
+
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+
+from bme280_driver import BME280
+from imu_calibration import begin, calibration_path, load_calibration
+from imu_fusion import MadgwickFusion, create_fusion, euler_batch
+from mpu9250_fifo import MPU9250Fifo
+from scheduler import MissPolicy
+from sensor_host import SensorDriver, register_driver
+from sensor_pipeline import MotionGate
+from sensor_sim import SimulatedFifo, create_bme_backend, create_imu_backend
+
+
+def open_imu(bus, mpu_settings: dict):
+    if mpu_settings.get("backend", "hardware") == "hardware":
+        from imusensor.MPU9250 import MPU9250
+
+        return MPU9250.MPU9250(bus, int(mpu_settings["address"]))
+    return create_imu_backend(mpu_settings)
+
+
+@register_driver
+class BMEDriver(SensorDriver):
+    name = "bme"
+    fields = (("temperature", "topic-temp"), ("humidity", "topic-humidity"), ("pressure", "topic-pressure"))
+
+    @property
+    def uses_bus(self) -> bool:
+        return self.settings.get("backend", "hardware") == "hardware"
+
+    def open(self, bus):
+        if self.uses_bus:
+            self.bme280 = BME280.from_settings(bus, self.settings)
+        else:
+            self.bme280 = create_bme_backend(self.settings)
+        # a forced conversion takes several ms, which the shared scheduler thread can't sleep through,
+        # so each poll reads the conversion started by the previous one and starts the next
+        self._forced = self.uses_bus and self.bme280.mode == "forced"
+        self._started: Optional[float] = None
+
+    def poll(self):
+        if not self._forced:
+            with self.bus_lock:
+                reading = self.bme280.read()
+            self.emit(time.monotonic(), (reading.temperature, reading.humidity, reading.pressure))
+            return
+
+        with self.bus_lock:
+            if self._started is not None and self.bme280.measuring():
+                # polled faster than a conversion, try again next tick
+                return
+            reading = None if self._started is None else self.bme280.read_result()
+            started = self._started
+            self.bme280.start_measurement()
+            self._started = time.monotonic()
+        if reading is not None:
+            self.emit(started, (reading.temperature, reading.humidity, reading.pressure))
+
+
+@register_driver
+class MPUDriver(SensorDriver):
+    """
+    Three acquisition modes, all sampling at sample-rate when it is set:
+    poll   - imusensor orientation once per sample, defaults to once per update-speed
+    fusion - read one sample per period, fuse a batch every update-speed, defaults to fusion.sample-rate
+    fifo   - drain the sensor FIFO every update-speed and fuse the batch, defaults to fifo.sample-rate
+    """
+    name = "mpu"
+    fields = (("roll", "topic-roll"), ("pitch", "topic-pitch"), ("yaw", "topic-yaw"))
+    circular = (True, True, True)
+    fifo = None
+    fusion = None
+
+    @property
+    def uses_bus(self) -> bool:
+        return self.settings.get("backend", "hardware") == "hardware"
+
+    @property
+    def sample_rate(self) -> float:
+        # the FIFO can only run at 1kHz / integer divider
+        if self.fifo:
+            return self.fifo.sample_rate
+        fusion_settings = self.settings.get("fusion", {})
+        if "sample-rate" not in self.settings and fusion_settings.get("algorithm", "none").lower() != "none":
+            return fusion_settings.get("sample-rate", 100)
+        return super().sample_rate
+
+    @property
+    def period(self) -> float:
+        return self.settings["update-speed"] if self.fifo else 1 / self.sample_rate
+
+    @property
+    def policy(self) -> MissPolicy:
+        # fusion integrates gyro over real sample intervals, late samples are better than none
+        return MissPolicy.CATCH_UP if self.fusion and not self.fifo else MissPolicy.SKIP
+
+    def open(self, bus):
+        self.imu = open_imu(bus, self.settings)
+        path = calibration_path(self.settings)
+        calibration = load_calibration(path, int(self.settings["address"]))
+        if calibration is None:
+            logging.warning(f"No IMU calibration in {path}, calibrating gyro at startup. "
+                            f"Run kevinbot-sensor-mpu.py --calibrate to save one")
+        else:
+            logging.info(f"Loaded IMU calibration ({', '.join(calibration.calibrated) or 'none'}) "
+                         f"from {path}")
+        self.calibration = begin(self.imu, calibration)
+
+        if self.settings.get("acquisition", "poll") == "fifo":
+            if self.uses_bus:
+                self.fifo = MPU9250Fifo.from_settings(bus, self.settings)
+            else:
+                self.fifo = SimulatedFifo(self.imu, self.settings.get(
+                    "sample-rate", self.settings.get("fifo", {}).get("sample-rate", 200)))
+            if self.settings["update-speed"] >= self.fifo.fifo_duration:
+                logging.warning(f"update-speed {self.settings['update-speed']}s is longer than the FIFO holds "
+                                f"({self.fifo.fifo_duration:.3f}s at {self.fifo.sample_rate:.1f}Hz), "
+                                f"expect overflows")
+
+        self.fusion = create_fusion(self.settings.get("fusion", {}), 1 / self.sample_rate)
+        self.use_mag = self.settings.get("fusion", {}).get("use-mag", True)
+        self._last_stamp = None
+
+        if self.fifo:
+            if not self.fusion:
+                logging.warning("FIFO acquisition needs a fusion algorithm, using Madgwick")
+                self.fusion = MadgwickFusion(self.fifo.period)
+            self.fifo.configure()
+        elif self.fusion:
+            batch = max(1, round(self.settings["update-speed"] * self.sample_rate))
+            self._gyro = np.empty((batch, 3))
+            self._accel = np.empty((batch, 3))
+            self._mag = np.empty((batch, 3))
+            self._stamps = np.empty(batch)
+            self._index = 0
+
+        self.gate = MotionGate.from_settings(self.settings.get("adaptive", {}), self.sample_rate)
+
+    def poll(self):
+        if self.fifo:
+            self._poll_fifo()
+        elif self.fusion:
+            self._poll_fusion()
+        else:
+            self._poll_orientation()
+
+    def _fuse(self, timestamps, gyro, accel, mag):
+        if self._last_stamp is None:
+            self._last_stamp = timestamps[0] - self.fusion.sample_period
+        quaternions = self.fusion.update_batch(gyro, accel, mag, np.diff(timestamps, prepend=self._last_stamp),
+                                               history=True)
+        self._last_stamp = timestamps[-1]
+        if self.gate:
+            self.gate.update(timestamps, gyro, accel)
+        self.emit(timestamps, euler_batch(quaternions))
+
+    def _poll_orientation(self):
+        with self.bus_lock:
+            self.imu.readSensor()
+        stamp = time.monotonic()
+        self.imu.computeOrientation()
+        if self.gate:
+            self.gate.update(stamp, self.imu.GyroVals, self.imu.AccelVals)
+        self.emit(stamp, (self.imu.roll, self.imu.pitch, self.imu.yaw))
+
+    def _poll_fusion(self):
+        with self.bus_lock:
+            self.imu.readSensor()
+        index = self._index
+        self._stamps[index] = time.monotonic()
+        self._gyro[index] = self.imu.GyroVals
+        self._accel[index] = self.imu.AccelVals
+        self._mag[index] = self.imu.MagVals
+        self._index += 1
+
+        if self._index < len(self._stamps):
+            return
+        self._index = 0
+        self._fuse(self._stamps, self._gyro, self._accel, self._mag if self.use_mag else None)
+
+    def _poll_fifo(self):
+        with self.bus_lock:
+            batch = self.fifo.drain()
+            if batch.overflowed:
+                logging.warning(f"MPU FIFO overflowed ({self.fifo.overflows} total), samples dropped")
+                self._last_stamp = None
+                return
+            if not len(batch):
+                return
+
+            mag = None
+            if self.use_mag:
+                # the magnetometer isn't routed through the FIFO, hold one reading across the batch
+                self.imu.readSensor()
+                mag = np.broadcast_to(self.imu.MagVals, batch.accel.shape)
+
+        accel, gyro = self.calibration.correct(batch.accel, batch.gyro)
+        self._fuse(batch.timestamps, gyro, accel, mag)
@@ -0,0 +1,241 @@
+"""
+Kevinbot v3 sensor host
+Runs pluggable sensor drivers on one scheduler, one MQTT connection and one shared I2C bus
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from paho.mqtt import client as mqtt_client
+
+from mqtt_publisher import QueuedPublisher, TopicPolicy
+from scheduler import MissPolicy, Scheduler
+from sensor_pipeline import DecimationPipeline, MotionGate
+from sensor_recorder import SensorRecorder
+
+PublishFunction = Callable[[str, Any], None]
+
+
+class SensorDriver(ABC):
+    """
+    Base class for a sensor hosted by SensorHost.
+    `poll` is called every `period` seconds from the scheduler thread, hardware access
+    should happen while holding `bus_lock`. Samples are handed to `emit`, which records
+    them and publishes the decimated streams.
+    """
+    name = ""
+    policy = MissPolicy.SKIP
+    uses_bus = True
+    # (field name, settings key of the field's topic) for every published value
+    fields: Tuple[Tuple[str, str], ...] = ()
+    # per field, True for angles in degrees that need circular averaging
+    circular: Tuple[bool, ...] = ()
+
+    def __init__(self, service_settings: dict, publish: PublishFunction, bus_lock: threading.Lock):
+        self.settings = service_settings
+        self.publish = publish
+        self.bus_lock = bus_lock
+        self.recorder: Optional[SensorRecorder] = None
+        self.pipeline: Optional[DecimationPipeline] = None
+        # drivers that can sense motion set this to publish only a heartbeat while still
+        self.gate: Optional[MotionGate] = None
+        self.topics = [service_settings[topic] for _, topic in self.fields]
+        # optional JSON topic carrying every published sample with its capture time and sequence number
+        self.samples_topic: Optional[str] = service_settings.get("topic-samples")
+        # samples captured so far
+        self.sequence = 0
+
+    @property
+    def sample_rate(self) -> float:
+        return self.settings.get("sample-rate", 1 / self.settings["update-speed"])
+
+    @property
+    def period(self) -> float:
+        return 1 / self.sample_rate
+
+    def open(self, bus):
+        pass
+
+    def start_pipeline(self):
+        self.pipeline = DecimationPipeline.from_settings(self.settings, self.sample_rate,
+                                                         len(self.fields), self.circular)
+
+    def emit(self, timestamps, values):
+        """Hand over (N,) monotonic capture times and (N, F) samples at the sample rate"""
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        values = np.asarray(values, dtype=np.float64).reshape(len(timestamps), len(self.fields))
+        if not len(timestamps):
+            return
+        self.sequence += len(timestamps)
+
+        if self.recorder:
+            self.recorder.record_many(timestamps + (time.time() - time.monotonic()), values)
+
+        for output in self.pipeline.push(timestamps, values):
+            if not output.publish:
+                continue
+            stamps = output.timestamps.tolist()
+            rows = output.values.tolist()
+            indices = range(len(stamps)) if self.gate is None else self.gate.select(output.name, stamps)
+            for index in indices:
+                row = [round(value, 2) for value in rows[index]]
+                for topic, value in zip(self.topics, row):
+                    self.publish(topic + output.topic_suffix, value)
+                if self.samples_topic:
+                    sample = {"seq": output.sequence + index, "t": round(stamps[index], 6)}
+                    sample.update(zip((field for field, _ in self.fields), row))
+                    self.publish(self.samples_topic + output.topic_suffix, json.dumps(sample))
+
+    @abstractmethod
+    def poll(self):
+        """Read the sensor and emit its samples"""
+
+    def close(self):
+        pass
+
+
+_drivers: Dict[str, Type[SensorDriver]] = {}
+
+
+def register_driver(driver: Type[SensorDriver]) -> Type[SensorDriver]:
+    _drivers[driver.name] = driver
+    return driver
+
+
+def get_driver(name: str) -> Type[SensorDriver]:
+    if name not in _drivers:
+        raise KeyError(f"Unknown sensor driver {name}, available: {', '.join(sorted(_drivers))}")
+    return _drivers[name]
+
+
+def open_bus(number: int):
+    import smbus
+
+    return smbus.SMBus(number)
+
+
+class SensorHost:
+    def __init__(self, settings: dict, driver_names: List[str], client_name: str = "sensors"):
+        self.settings = settings
+        self.driver_names = driver_names
+        self.client_id = f"kevinbot-{client_name}-{uuid.uuid4()}"
+        self.bus_lock = threading.Lock()
+        self.scheduler = Scheduler()
+        self.drivers: List[SensorDriver] = []
+        self.client: Optional[mqtt_client.Client] = None
+        self.publisher: Optional[QueuedPublisher] = None
+        self.bus = None
+        self._diagnostics_mark: Dict[str, Tuple[float, int]] = {}
+
+    def publish(self, topic: str, msg: Any):
+        self.publisher.publish(topic, msg)
+
+    def connect(self):
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                logging.info("Connected to MQTT Broker")
+            else:
+                logging.critical("Failed to connect, return code %d\n", rc)
+
+        mqtt_settings = self.settings["services"]["mqtt"]
+        self.client = mqtt_client.Client(self.client_id)
+        self.client.on_connect = on_connect
+        self.client.connect(mqtt_settings["address"], mqtt_settings["port"])
+        self.publisher = QueuedPublisher(self.client,
+                                         max_queue=mqtt_settings.get("max-queue", 256),
+                                         max_inflight=mqtt_settings.get("max-inflight", 20))
+        self.publisher.start()
+        self.client.loop_start()
+
+    def open_drivers(self):
+        services = self.settings["services"]
+        for name in self.driver_names:
+            service_settings = services[name]
+            if not service_settings.get("enabled", True):
+                logging.warning(f"{name.upper()} sensor is not enabled, skipping")
+                continue
+
+            driver = get_driver(name)(service_settings, self.publish, self.bus_lock)
+            record_settings = services.get("sensors", {}).get("record", {})
+            if record_settings.get("enabled", False) and driver.fields:
+                driver.recorder = SensorRecorder.from_settings(
+                    record_settings, name, [field for field, _ in driver.fields], driver.topics)
+            with self.bus_lock:
+                if driver.uses_bus and self.bus is None:
+                    self.bus = open_bus(services.get("sensors", {}).get("bus", 1))
+                driver.open(self.bus)
+            driver.start_pipeline()
+            self.set_policies(driver)
+            self.drivers.append(driver)
+            self.scheduler.add_job(name, driver.period, driver.poll, driver.policy)
+            streams = ", ".join(f"{stream} {rate:g}Hz" for stream, rate in driver.pipeline.rates.items())
+            logging.info(f"Started {name} sensor driver sampling at {driver.sample_rate:g}Hz ({streams})")
+
+    def set_policies(self, driver: SensorDriver):
+        """
+        Fusion and FIFO acquisition emit a batch per poll, which the publisher would collapse to its
+        last value. Streams faster than update-speed keep every value, slower ones only need the newest.
+        Per-sample JSON always keeps every message, its sequence numbers are how consumers count drops.
+        """
+        for stream in driver.pipeline.streams:
+            if not stream.publish:
+                continue
+            if driver.sample_rate / stream.factor * driver.settings["update-speed"] > 1:
+                for topic in driver.topics:
+                    self.publisher.set_policy(topic + stream.topic_suffix, TopicPolicy.FIFO)
+            if driver.samples_topic:
+                self.publisher.set_policy(driver.samples_topic + stream.topic_suffix, TopicPolicy.FIFO)
+
+    def publish_diagnostics(self):
+        """Advertised vs delivered sample rates and loop timing histograms for every driver"""
+        now = time.monotonic()
+        jobs = self.scheduler.jobs
+        diagnostics = {}
+        for driver in self.drivers:
+            last_time, last_sequence = self._diagnostics_mark.get(driver.name, (now, driver.sequence))
+            self._diagnostics_mark[driver.name] = (now, driver.sequence)
+            elapsed = now - last_time
+            diagnostics[driver.name] = {
+                "sample_rate": driver.sample_rate,
+                "measured_rate": round((driver.sequence - last_sequence) / elapsed, 3) if elapsed > 0 else 0.0,
+                "samples": driver.sequence,
+                "streams": {stream.name: {"rate": round(driver.sample_rate / stream.factor, 3),
+                                          "sequence": stream.sequence}
+                            for stream in driver.pipeline.streams},
+                "loop": jobs[driver.name].stats.as_dict(),
+            }
+            if driver.gate:
+                diagnostics[driver.name]["still"] = driver.gate.still
+        self.publish(self.settings["services"]["sensors"]["topic-diagnostics"], json.dumps(diagnostics))
+
+    def run(self):
+        # drivers register themselves on import
+        import sensor_drivers  # noqa: F401
+
+        self.connect()
+        self.open_drivers()
+        if not self.drivers:
+            logging.warning("No sensor drivers enabled, exiting")
+            return
+
+        sensors_settings = self.settings["services"].get("sensors", {})
+        if sensors_settings.get("topic-diagnostics"):
+            self._diagnostics_mark = {driver.name: (time.monotonic(), driver.sequence) for driver in self.drivers}
+            self.scheduler.add_job("diagnostics", sensors_settings.get("diagnostics-interval", 5),
+                                   self.publish_diagnostics)
+
+        try:
+            self.scheduler.run_forever()
+        finally:
+            for driver in self.drivers:
+                driver.close()
+                if driver.recorder:
+                    driver.recorder.close()
+            self.publisher.stop()
+            self.client.loop_stop()
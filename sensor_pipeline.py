@@ -0,0 +1,193 @@
+"""
+Multi-rate decimation for Kevinbot v3 sensors
+Splits one high-rate sample stream into several block-averaged, lower-rate streams
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+@dataclass
+class StreamOutput:
+    name: str
+    topic_suffix: str
+    publish: bool
+    sequence: int  # sequence number of the first value
+    timestamps: np.ndarray  # (M,)
+    values: np.ndarray  # (M, F)
+
+
+class DecimatedStream:
+    def __init__(self, name: str, factor: int, field_count: int, circular: Sequence[bool] = (),
+                 topic_suffix: str = "", publish: bool = True):
+        if factor < 1:
+            raise ValueError(f"Stream {name} decimation factor must be at least 1, got {factor}")
+
+        self.name = name
+        self.factor = factor
+        self.field_count = field_count
+        self.topic_suffix = topic_suffix
+        self.publish = publish
+        self.circular = np.zeros(field_count, dtype=bool)
+        self.circular[:len(circular)] = circular
+
+        # counts every value the stream has produced, gaps downstream show up as skipped numbers
+        self.sequence = 0
+        self._times = np.empty(0)
+        self._values = np.empty((0, field_count))
+
+    def _output(self, timestamps: np.ndarray, values: np.ndarray) -> StreamOutput:
+        output = StreamOutput(self.name, self.topic_suffix, self.publish, self.sequence, timestamps, values)
+        self.sequence += len(timestamps)
+        return output
+
+    def push(self, timestamps: np.ndarray, values: np.ndarray) -> StreamOutput:
+        if self.factor == 1:
+            return self._output(timestamps, values)
+
+        if len(self._times):
+            timestamps = np.concatenate([self._times, timestamps])
+            values = np.concatenate([self._values, values])
+
+        blocks = len(timestamps) // self.factor
+        used = blocks * self.factor
+        self._times = timestamps[used:].copy()
+        self._values = values[used:].copy()
+
+        block_values = values[:used].reshape(blocks, self.factor, self.field_count)
+        # boxcar average over each block is the anti-alias filter for the decimation
+        out = block_values.mean(axis=1)
+        if self.circular.any():
+            # angles are averaged on the unit circle so ±180° doesn't average to 0°
+            angles = np.radians(block_values[:, :, self.circular])
+            out[:, self.circular] = np.degrees(np.arctan2(np.sin(angles).mean(axis=1),
+                                                          np.cos(angles).mean(axis=1)))
+        # a block's value describes the moment its last sample was captured
+        out_times = timestamps[self.factor - 1:used:self.factor]
+        return self._output(out_times, out)
+
+    def reset(self):
+        self._times = np.empty(0)
+        self._values = np.empty((0, self.field_count))
+
+
+class DecimationPipeline:
+    def __init__(self, sample_rate: float, field_count: int, streams: Dict[str, dict],
+                 circular: Sequence[bool] = ()):
+        self.sample_rate = sample_rate
+        self.field_count = field_count
+        self.streams: List[DecimatedStream] = []
+        for name, stream_settings in streams.items():
+            rate = stream_settings["rate"]
+            factor = round(sample_rate / rate)
+            if factor < 1:
+                raise ValueError(f"Stream {name} rate {rate}Hz is above the {sample_rate}Hz sample rate")
+            self.streams.append(DecimatedStream(name, factor, field_count, circular,
+                                                topic_suffix=stream_settings.get("suffix", f"/{name}"),
+                                                publish=stream_settings.get("publish", True)))
+
+    @classmethod
+    def from_settings(cls, service_settings: dict, sample_rate: float, field_count: int,
+                      circular: Sequence[bool] = ()):
+        # without explicit streams, behave like the old loop and publish at update-speed to the base topics
+        streams = service_settings.get("streams") or {
+            "default": {"rate": 1 / service_settings["update-speed"], "suffix": ""}}
+        return cls(sample_rate, field_count, streams, circular)
+
+    def push(self, timestamps, values) -> List[StreamOutput]:
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        values = np.asarray(values, dtype=np.float64).reshape(len(timestamps), self.field_count)
+        return [stream.push(timestamps, values) for stream in self.streams]
+
+    def stream(self, name: str) -> Optional[DecimatedStream]:
+        for stream in self.streams:
+            if stream.name == name:
+                return stream
+        return None
+
+    def reset(self):
+        for stream in self.streams:
+            stream.reset()
+
+    @property
+    def rates(self) -> Dict[str, float]:
+        return {stream.name: self.sample_rate / stream.factor for stream in self.streams}
+
+
+class MotionGate:
+    """
+    Throttles published streams to a heartbeat while the sensor is still.
+    Motion is gyro energy around zero, so a steady turn counts, or accel variance over a short window.
+    The gate opens on the first moving window and only closes after still-time of quiet.
+    """
+
+    def __init__(self, sample_rate: float, gyro_threshold: float = 0.05, accel_threshold: float = 0.15,
+                 window: float = 0.5, still_time: float = 2.0, heartbeat: float = 1.0):
+        self.gyro_threshold = gyro_threshold
+        self.accel_threshold = accel_threshold
+        self.still_time = still_time
+        self.heartbeat = heartbeat
+        self.size = max(2, round(window * sample_rate))
+        self.still = False
+        self.transitions = 0
+
+        self._gyro = np.zeros((self.size, 3))
+        self._accel = np.zeros((self.size, 3))
+        self._index = 0
+        self._count = 0
+        self._quiet_since: Optional[float] = None
+        self._last_sent: Dict[str, float] = {}
+
+    @classmethod
+    def from_settings(cls, adaptive_settings: dict, sample_rate: float):
+        if not adaptive_settings.get("enabled", False):
+            return None
+        return cls(sample_rate,
+                   gyro_threshold=adaptive_settings.get("gyro-threshold", 0.05),
+                   accel_threshold=adaptive_settings.get("accel-threshold", 0.15),
+                   window=adaptive_settings.get("window", 0.5),
+                   still_time=adaptive_settings.get("still-time", 2.0),
+                   heartbeat=adaptive_settings.get("heartbeat", 1.0))
+
+    def update(self, timestamps, gyro, accel) -> bool:
+        """Feed (N,) timestamps with (N, 3) gyro in rad/s and accel in m/s^2, returns True while moving"""
+        gyro = np.asarray(gyro, dtype=np.float64).reshape(-1, 3)[-self.size:]
+        accel = np.asarray(accel, dtype=np.float64).reshape(-1, 3)[-self.size:]
+        if not len(gyro):
+            return not self.still
+
+        slots = (self._index + np.arange(len(gyro))) % self.size
+        self._gyro[slots] = gyro
+        self._accel[slots] = accel
+        self._index = int(slots[-1] + 1) % self.size
+        self._count = min(self._count + len(gyro), self.size)
+
+        gyro_rms = np.sqrt(np.mean(np.sum(self._gyro[:self._count] ** 2, axis=1)))
+        accel_std = np.sqrt(np.sum(np.var(self._accel[:self._count], axis=0)))
+        now = float(np.atleast_1d(timestamps)[-1])
+
+        if gyro_rms > self.gyro_threshold or accel_std > self.accel_threshold:
+            self._quiet_since = None
+            if self.still:
+                self.still = False
+                self.transitions += 1
+        else:
+            if self._quiet_since is None:
+                self._quiet_since = now
+            if not self.still and now - self._quiet_since >= self.still_time:
+                self.still = True
+                self.transitions += 1
+        return not self.still
+
+    def select(self, stream: str, timestamps: Sequence[float]) -> List[int]:
+        """Indices of the stream's values to publish, everything while moving, one per heartbeat while still"""
+        last = self._last_sent.get(stream, float("-inf"))
+        keep = []
+        for index, stamp in enumerate(timestamps):
+            if not self.still or stamp - last >= self.heartbeat:
+                keep.append(index)
+                last = stamp
+        self._last_sent[stream] = last
+        return keep
@@ -0,0 +1,248 @@
+"""
+Kevinbot v3 sensor recorder
+Appends fixed-width records to preallocated, memory-mapped segment files and reads them back with NumPy
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MAGIC = b"KBSR"
+VERSION = 1
+HEADER_SIZE = 4096
+EXTENSION = ".kbsr"
+# a change this large between wall and monotonic clock is a clock step, which starts a new segment
+CLOCK_STEP = 1.0
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# fixed part of the header, followed by a JSON description padded to HEADER_SIZE
+_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"), ("count", "<u8"),
+                          ("capacity", "<u8"), ("meta_size", "<u4")])
+
+
+def resolve_directory(directory: str) -> str:
+    """Log directories from settings are relative to the install, not the working directory"""
+    return os.path.join(CURRENT_DIR, directory)
+
+
+def record_dtype(fields: Sequence[str]) -> np.dtype:
+    return np.dtype([("t", "<f8")] + [(name, "<f4") for name in fields])
+
+
+class SegmentWriter:
+    def __init__(self, path: str, stream: str, fields: Sequence[str], topics: Sequence[str], capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.dtype = record_dtype(fields)
+
+        meta = json.dumps({"stream": stream, "fields": list(fields), "topics": list(topics),
+                           "created": time.time()}).encode("utf-8")
+        if _HEADER_DTYPE.itemsize + len(meta) > HEADER_SIZE:
+            raise ValueError("Sensor log metadata does not fit in the header")
+
+        with open(path, "wb") as f:
+            f.truncate(HEADER_SIZE + capacity * self.dtype.itemsize)
+
+        self._header = np.memmap(path, dtype=_HEADER_DTYPE, mode="r+", shape=(1,))
+        self._header[0] = (MAGIC, VERSION, 0, capacity, len(meta))
+        meta_view = np.memmap(path, dtype=np.uint8, mode="r+", offset=_HEADER_DTYPE.itemsize, shape=(len(meta),))
+        meta_view[:] = np.frombuffer(meta, dtype=np.uint8)
+        meta_view.flush()
+        del meta_view
+
+        self._records = np.memmap(path, dtype=self.dtype, mode="r+", offset=HEADER_SIZE, shape=(capacity,))
+        self.count = 0
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    @property
+    def space(self) -> int:
+        return self.capacity - self.count
+
+    def append(self, timestamp: float, values: Sequence[float]):
+        self._records[self.count] = (timestamp, *values)
+        self.count += 1
+        # the count is what readers trust, so it is updated after the record itself
+        self._header["count"] = self.count
+
+    def append_many(self, timestamps: np.ndarray, values: np.ndarray):
+        end = self.count + len(timestamps)
+        block = self._records[self.count:end]
+        block["t"] = timestamps
+        for index, name in enumerate(self.dtype.names[1:]):
+            block[name] = values[:, index]
+        self.count = end
+        self._header["count"] = self.count
+
+    def close(self):
+        self._records.flush()
+        self._header.flush()
+        del self._records
+        del self._header
+
+
+class SensorRecorder:
+    def __init__(self, directory: str, stream: str, fields: Sequence[str], topics: Sequence[str],
+                 segment_records: int = 36000, max_segments: int = 48):
+        self.directory = directory
+        self.stream = stream
+        self.fields = list(fields)
+        self.topics = list(topics)
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+
+        self._segment: Optional[SegmentWriter] = None
+        self._clock_offset: Optional[float] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # numbering carries on from the previous run so segments keep their order
+        existing = segment_paths(directory, stream)
+        self._sequence = _parse_name(existing[-1])[1] + 1 if existing else 0
+
+    @classmethod
+    def from_settings(cls, record_settings: dict, stream: str, fields: Sequence[str], topics: Sequence[str]):
+        return cls(resolve_directory(record_settings.get("directory", "logs/sensors")), stream, fields, topics,
+                   segment_records=record_settings.get("segment-records", 36000),
+                   max_segments=record_settings.get("max-segments", 48))
+
+    def record(self, values: Sequence[float], timestamp: Optional[float] = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._check_clock()
+            if self._segment is None or self._segment.full:
+                self._rotate()
+            self._segment.append(timestamp, values)
+
+    def record_many(self, timestamps, values):
+        """Append (N,) timestamps and (N, F) values, split across segments as needed"""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values).reshape(len(timestamps), len(self.fields))
+        with self._lock:
+            self._check_clock()
+            start = 0
+            while start < len(timestamps):
+                if self._segment is None or self._segment.full:
+                    self._rotate()
+                end = start + min(self._segment.space, len(timestamps) - start)
+                self._segment.append_many(timestamps[start:end], values[start:end])
+                start = end
+
+    def _check_clock(self):
+        # segments stay continuous in time, so replay can drop the gap between them
+        offset = time.time() - time.monotonic()
+        if self._segment is not None and abs(offset - self._clock_offset) > CLOCK_STEP:
+            self._rotate()
+        self._clock_offset = offset
+
+    def _rotate(self):
+        if self._segment is not None:
+            self._segment.close()
+
+        name = f"{self.stream}-{self._sequence:06d}-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}{EXTENSION}"
+        self._sequence += 1
+        self._segment = SegmentWriter(os.path.join(self.directory, name), self.stream,
+                                      self.fields, self.topics, self.segment_records)
+
+        for old in segment_paths(self.directory, self.stream)[:-self.max_segments]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+
+
+class SensorLog:
+    def __init__(self, meta: dict, records: np.ndarray, segment_starts: Optional[Sequence[int]] = None):
+        self.stream = meta["stream"]
+        self.fields = meta["fields"]
+        self.topics = meta["topics"]
+        self.meta = meta
+        self.records = records
+        # index of the first record of every segment, time is only continuous within a segment
+        self.segment_starts = list(segment_starts) if segment_starts is not None else [0]
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.records["t"]
+
+    def column(self, field: str) -> np.ndarray:
+        return self.records[field]
+
+    def playback_offsets(self) -> np.ndarray:
+        """
+        Seconds from the first record for replay. Segments are placed one sample interval apart, so
+        service restarts and clock steps between them are neither slept through nor run backwards.
+        """
+        offsets = np.empty(len(self.records))
+        bounds = [start for start in self.segment_starts if start < len(self.records)] + [len(self.records)]
+        position = 0.0
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end <= start:
+                # a segment with no records, e.g. after a crash right after rotating
+                continue
+            stamps = self.timestamps[start:end]
+            offsets[start:end] = position + (stamps - stamps[0])
+            interval = float(np.median(np.diff(stamps))) if len(stamps) > 1 else 0.0
+            position = offsets[end - 1] + interval
+        return offsets
+
+
+def read_segment(path: str) -> SensorLog:
+    """Memory-map one segment, only the records written so far are returned"""
+    header = np.fromfile(path, dtype=_HEADER_DTYPE, count=1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError(f"{path} is not a Kevinbot sensor log")
+    if header["version"] != VERSION:
+        raise ValueError(f"{path} has unsupported version {header['version']}")
+
+    with open(path, "rb") as f:
+        f.seek(_HEADER_DTYPE.itemsize)
+        meta = json.loads(f.read(int(header["meta_size"])).decode("utf-8"))
+
+    count = int(header["count"])
+    if not count:
+        return SensorLog(meta, np.empty(0, dtype=record_dtype(meta["fields"])))
+    records = np.memmap(path, dtype=record_dtype(meta["fields"]), mode="r", offset=HEADER_SIZE, shape=(count,))
+    return SensorLog(meta, records)
+
+
+def _parse_name(path: str) -> Optional[Tuple[str, int]]:
+    """(stream, sequence) from a stream-sequence-utctime segment name, None for other files"""
+    parts = os.path.basename(path)[:-len(EXTENSION)].rsplit("-", 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+def segment_paths(directory: str, stream: str = "*") -> List[str]:
+    # ordered by sequence number, the time in the name is only for people and can step backwards
+    named = [(_parse_name(path), path) for path in glob.glob(os.path.join(directory, f"{stream}-*{EXTENSION}"))]
+    return [path for name, path in sorted((name, path) for name, path in named if name is not None)]
+
+
+def read_stream(directory: str, stream: str) -> SensorLog:
+    """Concatenate every segment of a stream, oldest first"""
+    logs = [read_segment(path) for path in segment_paths(directory, stream)]
+    if not logs:
+        raise FileNotFoundError(f"No {stream} logs in {directory}")
+    # segments left empty by a crash have no place in the timeline
+    logs = [log for log in logs if len(log)] or logs[-1:]
+    starts = np.cumsum([0] + [len(log) for log in logs[:-1]]).tolist()
+    return SensorLog(logs[-1].meta, np.concatenate([log.records for log in logs]), starts)
@@ -0,0 +1,274 @@
+"""
+Simulated sensor backends for Kevinbot v3
+Synthetic and log-replay stand-ins for the BME280 and MPU9250 so the sensor services run without hardware
+"""
+
+import math
+import time
+from typing import Callable, Tuple
+
+import numpy as np
+
+from bme280_driver import BME280Reading
+from mpu9250_fifo import FifoBatch, GRAVITY
+from sensor_recorder import read_stream, resolve_directory
+
+# earth field in the sensor's NED-ish world frame, µT
+EARTH_FIELD = np.array([20.0, 0.0, 45.0])
+
+# (times) -> (roll, pitch, yaw, roll rate, pitch rate, yaw rate), radians and rad/s
+MotionProfile = Callable[[np.ndarray], Tuple[np.ndarray, ...]]
+
+
+def motion_profile(sim_settings: dict) -> MotionProfile:
+    profile = sim_settings.get("profile", "still")
+    amplitude = math.radians(sim_settings.get("amplitude", 10.0))
+    frequency = sim_settings.get("frequency", 0.2)
+    yaw_rate = math.radians(sim_settings.get("yaw-rate", 15.0))
+    roll0 = math.radians(sim_settings.get("roll", 0.0))
+    pitch0 = math.radians(sim_settings.get("pitch", 0.0))
+    yaw0 = math.radians(sim_settings.get("yaw", 0.0))
+
+    def still(t):
+        zeros = np.zeros_like(t)
+        return zeros + roll0, zeros + pitch0, zeros + yaw0, zeros, zeros, zeros
+
+    def wobble(t, scale=1.0):
+        w = 2 * math.pi * frequency
+        roll = roll0 + scale * amplitude * np.sin(w * t)
+        pitch = pitch0 + scale * amplitude * np.sin(0.7 * w * t)
+        return (roll, pitch, np.zeros_like(t) + yaw0,
+                scale * amplitude * w * np.cos(w * t),
+                scale * amplitude * 0.7 * w * np.cos(0.7 * w * t),
+                np.zeros_like(t))
+
+    def rotate(t):
+        zeros = np.zeros_like(t)
+        return zeros + roll0, zeros + pitch0, yaw0 + yaw_rate * t, zeros, zeros, zeros + yaw_rate
+
+    def drive(t):
+        roll, pitch, _, roll_rate, pitch_rate, _ = wobble(t, 0.3)
+        _, _, yaw, _, _, yaw_rate_ = rotate(t)
+        return roll, pitch, yaw, roll_rate, pitch_rate, yaw_rate_
+
+    profiles = {"still": still, "wobble": wobble, "rotate": rotate, "drive": drive}
+    if profile not in profiles:
+        raise ValueError(f"Unknown motion profile {profile}, available: {', '.join(profiles)}")
+    return profiles[profile]
+
+
+def imu_samples(roll, pitch, yaw, roll_rate, pitch_rate, yaw_rate):
+    """Ideal accel (m/s^2), gyro (rad/s) and mag (µT) readings for (N,) euler angles and rates"""
+    sr, cr = np.sin(roll), np.cos(roll)
+    sp, cp = np.sin(pitch), np.cos(pitch)
+    sy, cy = np.sin(yaw), np.cos(yaw)
+
+    accel = GRAVITY * np.stack([-sp, sr * cp, cr * cp], axis=-1)
+
+    # euler rates -> body rates (ZYX)
+    gyro = np.stack([roll_rate - yaw_rate * sp,
+                     pitch_rate * cr + yaw_rate * cp * sr,
+                     -pitch_rate * sr + yaw_rate * cp * cr], axis=-1)
+
+    # body = R^T world, R = Rz(yaw) Ry(pitch) Rx(roll)
+    rotation = np.empty(roll.shape + (3, 3))
+    rotation[..., 0, 0] = cy * cp
+    rotation[..., 0, 1] = cy * sp * sr - sy * cr
+    rotation[..., 0, 2] = cy * sp * cr + sy * sr
+    rotation[..., 1, 0] = sy * cp
+    rotation[..., 1, 1] = sy * sp * sr + cy * cr
+    rotation[..., 1, 2] = sy * sp * cr - cy * sr
+    rotation[..., 2, 0] = -sp
+    rotation[..., 2, 1] = cp * sr
+    rotation[..., 2, 2] = cp * cr
+    mag = np.einsum("...ji,j->...i", rotation, EARTH_FIELD)
+
+    return accel, gyro, mag
+
+
+class SimulatedIMU:
+    """
+    Stand-in for imusensor's MPU9250 driven by an orientation trajectory.
+    Exposes readSensor/computeOrientation, the AccelVals/GyroVals/MagVals/roll/pitch/yaw attributes
+    and imusensor's calibration attributes, which readSensor applies the same way.
+    """
+
+    def __init__(self, trajectory: MotionProfile, accel_noise: float = 0.05, gyro_noise: float = 0.005,
+                 mag_noise: float = 0.5, gyro_drift: float = 0.0, gyro_bias=(0.0, 0.0, 0.0),
+                 accel_bias=(0.0, 0.0, 0.0), mag_bias=(0.0, 0.0, 0.0), seed=None):
+        self.trajectory = trajectory
+        self.accel_noise = accel_noise
+        self.gyro_noise = gyro_noise
+        self.mag_noise = mag_noise
+        self.gyro_drift = gyro_drift
+        self.rng = np.random.default_rng(seed)
+        self.gyro_bias = np.array(gyro_bias, dtype=np.float64)
+        self.accel_bias = np.array(accel_bias, dtype=np.float64)
+        self.mag_bias = np.array(mag_bias, dtype=np.float64)
+        self.start = time.monotonic()
+        self._last = 0.0
+
+        self.AccelVals = np.zeros(3)
+        self.GyroVals = np.zeros(3)
+        self.MagVals = np.zeros(3)
+        self.roll = self.pitch = self.yaw = 0.0
+
+        self.GyroBias = np.zeros(3)
+        self.AccelBias = np.zeros(3)
+        self.Accels = np.ones(3)
+        self.MagBias = np.zeros(3)
+        self.Mags = np.ones(3)
+        self.Magtransform = None
+
+    def begin(self):
+        self.start = time.monotonic()
+        self._last = 0.0
+
+    def samples(self, times: np.ndarray):
+        """Noisy, uncalibrated readings at (N,) seconds since start"""
+        accel, gyro, mag = imu_samples(*self.trajectory(times))
+        count = len(times)
+        if self.gyro_drift and count:
+            # bias random walk scaled by elapsed time
+            steps = np.diff(times, prepend=self._last)
+            walk = np.cumsum(self.rng.normal(0, self.gyro_drift, (count, 3)) * np.sqrt(np.abs(steps))[:, None], axis=0)
+            gyro = gyro + self.gyro_bias + walk
+            self.gyro_bias = self.gyro_bias + walk[-1]
+        else:
+            gyro = gyro + self.gyro_bias
+        if count:
+            self._last = float(times[-1])
+        return (accel + self.accel_bias + self.rng.normal(0, self.accel_noise, (count, 3)),
+                gyro + self.rng.normal(0, self.gyro_noise, (count, 3)),
+                mag + self.mag_bias + self.rng.normal(0, self.mag_noise, (count, 3)))
+
+    def readSensor(self):
+        accel, gyro, mag = self.samples(np.array([time.monotonic() - self.start]))
+        self.AccelVals = (accel[0] - self.AccelBias) * self.Accels
+        self.GyroVals = gyro[0] - self.GyroBias
+        if self.Magtransform is None:
+            self.MagVals = (mag[0] - self.MagBias) * self.Mags
+        else:
+            self.MagVals = np.matmul(mag[0] - self.MagBias, self.Magtransform)
+
+    def computeOrientation(self):
+        ax, ay, az = self.AccelVals
+        self.roll = math.degrees(math.atan2(ay, az))
+        self.pitch = math.degrees(math.atan2(-ax, math.sqrt(ay * ay + az * az)))
+        roll, pitch = math.radians(self.roll), math.radians(self.pitch)
+        mx, my, mz = self.MagVals
+        # tilt compensated heading
+        bx = mx * math.cos(pitch) + my * math.sin(roll) * math.sin(pitch) + mz * math.cos(roll) * math.sin(pitch)
+        by = my * math.cos(roll) - mz * math.sin(roll)
+        self.yaw = math.degrees(math.atan2(-by, bx))
+
+
+class SimulatedFifo:
+    """Drop-in for MPU9250Fifo that generates every sample since the last drain in one vectorised call"""
+
+    def __init__(self, imu: SimulatedIMU, sample_rate: float = 200):
+        self.imu = imu
+        self.sample_rate = sample_rate
+        self.period = 1 / sample_rate
+        self.overflows = 0
+        self._samples = 0
+
+    @property
+    def fifo_duration(self) -> float:
+        return float("inf")
+
+    def configure(self):
+        self._samples = 0
+
+    def drain(self) -> FifoBatch:
+        elapsed = time.monotonic() - self.imu.start
+        total = int(elapsed * self.sample_rate)
+        times = (self._samples + np.arange(total - self._samples)) * self.period
+        self._samples = total
+        accel, gyro, _ = self.imu.samples(times)
+        return FifoBatch(times + self.imu.start, accel, gyro)
+
+
+def replay_trajectory(directory: str, speed: float = 1.0) -> MotionProfile:
+    """Orientation trajectory interpolated from a recorded mpu log, looping at the end"""
+    log = read_stream(directory, "mpu")
+    offsets = log.playback_offsets()
+    duration = max(float(offsets[-1]), 1e-6)
+    angles = [np.unwrap(np.radians(log.column(field).astype(np.float64))) for field in ("roll", "pitch", "yaw")]
+    rates = [np.gradient(angle, offsets) if len(offsets) > 1 else np.zeros_like(angle) for angle in angles]
+
+    def trajectory(t):
+        position = (t * speed) % duration
+        return tuple(np.interp(position, offsets, series) for series in angles + rates)
+
+    return trajectory
+
+
+class SyntheticBME280:
+    def __init__(self, temperature: float = 25.0, humidity: float = 40.0, pressure: float = 1013.25,
+                 drift: float = 0.5, noise: float = 0.05, seed=None):
+        self.base = (temperature, humidity, pressure)
+        self.drift = drift
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.start = time.monotonic()
+
+    def read(self) -> BME280Reading:
+        hours = (time.monotonic() - self.start) / 3600
+        temperature, humidity, pressure = self.base
+        noise = self.rng.normal(0, self.noise, 3).tolist()
+        return BME280Reading(temperature + self.drift * hours + noise[0],
+                             min(max(humidity - self.drift * hours + noise[1] * 4, 0.0), 100.0),
+                             pressure + noise[2] * 2)
+
+
+class ReplayBME280:
+    def __init__(self, directory: str, speed: float = 1.0):
+        log = read_stream(directory, "bme")
+        self.offsets = log.playback_offsets()
+        self.duration = max(float(self.offsets[-1]), 1e-6)
+        self.columns = [log.column(field).astype(np.float64) for field in ("temperature", "humidity", "pressure")]
+        self.speed = speed
+        self.start = time.monotonic()
+
+    def read(self) -> BME280Reading:
+        position = ((time.monotonic() - self.start) * self.speed) % self.duration
+        return BME280Reading(*(float(np.interp(position, self.offsets, column)) for column in self.columns))
+
+
+def create_bme_backend(bme_settings: dict):
+    backend = bme_settings.get("backend", "hardware")
+    sim_settings = bme_settings.get("simulation", {})
+    if backend == "synthetic":
+        return SyntheticBME280(temperature=sim_settings.get("temperature", 25.0),
+                               humidity=sim_settings.get("humidity", 40.0),
+                               pressure=sim_settings.get("pressure", 1013.25),
+                               drift=sim_settings.get("drift", 0.5),
+                               noise=sim_settings.get("noise", 0.05),
+                               seed=sim_settings.get("seed"))
+    elif backend == "replay":
+        return ReplayBME280(resolve_directory(sim_settings.get("directory", "logs/sensors")),
+                            sim_settings.get("speed", 1.0))
+    raise ValueError(f"Unknown BME backend {backend}")
+
+
+def create_imu_backend(mpu_settings: dict) -> SimulatedIMU:
+    backend = mpu_settings.get("backend", "hardware")
+    sim_settings = mpu_settings.get("simulation", {})
+    if backend == "synthetic":
+        trajectory = motion_profile(sim_settings)
+    elif backend == "replay":
+        trajectory = replay_trajectory(resolve_directory(sim_settings.get("directory", "logs/sensors")),
+                                       sim_settings.get("speed", 1.0))
+    else:
+        raise ValueError(f"Unknown MPU backend {backend}")
+
+    return SimulatedIMU(trajectory,
+                        accel_noise=sim_settings.get("accel-noise", 0.05),
+                        gyro_noise=sim_settings.get("gyro-noise", 0.005),
+                        mag_noise=sim_settings.get("mag-noise", 0.5),
+                        gyro_drift=sim_settings.get("gyro-drift", 0.0),
+                        gyro_bias=sim_settings.get("gyro-bias", (0.0, 0.0, 0.0)),
+                        accel_bias=sim_settings.get("accel-bias", (0.0, 0.0, 0.0)),
+                        mag_bias=sim_settings.get("mag-bias", (0.0, 0.0, 0.0)),
+                        seed=sim_settings.get("seed"))
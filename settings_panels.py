@@ -20,6 +20,7 @@ import psutil
 import os
 import platform
 
+import procfs
 from system_options import SETTING_COMBOS
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -34,9 +35,7 @@ def save_json():
 
 
 def detect_model() -> str:
-    with open('/proc/device-tree/model') as f:
-        model = f.read()
-    return model
+    return procfs.board_model()
 
 
 class _SysInfoItem(QWidget):
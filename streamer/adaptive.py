@@ -0,0 +1,112 @@
+"""
+Kevinbot v3 streamer adaptive quality
+Moves each client up and down a ladder of shared variants based on how long its frames take to send
+"""
+
+import math
+import time
+from typing import List, Optional
+
+from camera import Variant
+
+DEFAULT_LADDER = [
+    {"name": "high", "scale": 1.0, "quality": 80, "fps": 30},
+    {"name": "medium", "scale": 0.75, "quality": 65, "fps": 15},
+    {"name": "low", "scale": 0.5, "quality": 50, "fps": 8},
+    {"name": "minimum", "scale": 0.25, "quality": 40, "fps": 4},
+]
+
+# lowest frame rate a client can cap to, keeps the send interval finite
+MIN_FPS = 0.1
+
+
+def ladder_from_settings(streamer_settings: dict) -> List[Variant]:
+    """Variants from best to worst"""
+    return [Variant(rung["name"], rung.get("scale", 1.0), rung.get("quality", 80), rung.get("fps", 30))
+            for rung in streamer_settings.get("ladder", DEFAULT_LADDER)]
+
+
+def cap_ladder(ladder: List[Variant], level: Optional[str] = None, quality: Optional[int] = None,
+               scale: Optional[float] = None, fps: Optional[float] = None) -> List[Variant]:
+    """
+    Client requested limits. Rungs above a quality or scale cap are dropped rather than re-encoded
+    so capped clients still share encodes, fps is free to change so it is clamped per rung.
+    A non-positive or non-finite fps is no cap.
+    """
+    if level is not None:
+        names = [variant.name for variant in ladder]
+        if level in names:
+            ladder = ladder[names.index(level):]
+    capped = [variant for variant in ladder
+              if (quality is None or variant.quality <= quality) and (scale is None or variant.scale <= scale)]
+    if not capped:
+        capped = ladder[-1:]
+    if fps is not None and math.isfinite(fps) and fps > 0:
+        capped = [Variant(variant.name, variant.scale, variant.quality, max(MIN_FPS, min(variant.fps, fps)))
+                  for variant in capped]
+    return capped
+
+
+class AdaptiveClient:
+    """
+    Send time relative to the frame interval is the client's load. Werkzeug writes straight to the
+    socket, so a full TCP buffer shows up as a slow send. High load steps down one rung at once,
+    low load has to hold for up_after seconds before stepping back up.
+    """
+
+    def __init__(self, ladder: List[Variant], down_load: float = 0.5, up_load: float = 0.2,
+                 up_after: float = 5.0, alpha: float = 0.3):
+        self.ladder = ladder
+        self.down_load = down_load
+        self.up_load = up_load
+        self.up_after = up_after
+        self.alpha = alpha
+        self.level = 0
+        self.load = 0.0
+        self.changes = 0
+
+        self._next_send = 0.0
+        self._stable_since = time.monotonic()
+
+    @classmethod
+    def from_settings(cls, ladder: List[Variant], adapt_settings: dict):
+        return cls(ladder,
+                   down_load=adapt_settings.get("down-load", 0.5),
+                   up_load=adapt_settings.get("up-load", 0.2),
+                   up_after=adapt_settings.get("up-after", 5.0),
+                   alpha=adapt_settings.get("alpha", 0.3))
+
+    @property
+    def variant(self) -> Variant:
+        return self.ladder[self.level]
+
+    def slot_delay(self) -> float:
+        """Seconds until the current rung's frame rate allows the next send"""
+        return max(0.0, self._next_send - time.monotonic())
+
+    def wait_for_slot(self):
+        delay = self.slot_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def sent(self, started: float, finished: float):
+        interval = 1 / self.variant.fps
+        # keep the cadence, but a client that was waiting on the camera doesn't bank more than one frame
+        self._next_send = max(self._next_send, started - interval) + interval
+        self.load += self.alpha * ((finished - started) / interval - self.load)
+
+        if self.load > self.down_load:
+            if self.level < len(self.ladder) - 1:
+                self._change(self.level + 1, finished)
+            self._stable_since = finished
+        elif self.load > self.up_load:
+            self._stable_since = finished
+        elif self.level > 0 and finished - self._stable_since >= self.up_after:
+            self._change(self.level - 1, finished)
+
+    def _change(self, level: int, now: float):
+        # the new rung has a different interval, so the old load says nothing about it
+        self.level = level
+        self.load = 0.0
+        self.changes += 1
+        self._stable_since = now
@@ -0,0 +1,249 @@
+"""
+Kevinbot v3 streamer asyncio server
+Serves the streamer endpoints from one event loop with non-blocking writes, so many viewers cost no threads
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import sys
+import time
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from camera import FrameHub, VideoCamera
+from metrics import PROMETHEUS_MIMETYPE, prometheus_text
+from multipart import PART_TRAILER, STREAM_MIMETYPE
+from stream import (FRAME_TIMEOUT, clients, collect_metrics, create_client, etag_matches, frame_etag,
+                    get_camera, settings, snapshot)
+
+MAX_HEADER_SIZE = 16384
+# seconds a client has to send its request headers
+REQUEST_TIMEOUT = 10.0
+
+
+@dataclass
+class Request:
+    method: str
+    target: str
+    path: str
+    query: Dict[str, str]
+    headers: Dict[str, str]
+    address: Optional[str]
+
+
+async def read_request(reader: asyncio.StreamReader, address: Optional[str]) -> Optional[Request]:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return None
+
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+    parts = request_line.split(" ")
+    if len(parts) != 3:
+        return None
+    method, target, _ = parts
+
+    headers = {}
+    for line in header_lines:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    url = urlsplit(target)
+    return Request(method.upper(), target, url.path, dict(parse_qsl(url.query)), headers, address)
+
+
+def response_head(status: int, headers: Dict[str, str]) -> bytes:
+    status = HTTPStatus(status)
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def write_buffers(writer: asyncio.StreamWriter, buffers):
+    # 3.12+ sends a list of buffers with one sendmsg, older versions join them into a copy first.
+    # Separate writes go straight to the socket and only the unsent remainder is buffered.
+    if sys.version_info >= (3, 12):
+        writer.writelines(buffers)
+    else:
+        for buffer in buffers:
+            writer.write(buffer)
+
+
+async def respond(writer: asyncio.StreamWriter, request: Request, status: int, body: bytes = b"",
+                  content_type: str = "text/plain; charset=utf-8", headers: Optional[Dict[str, str]] = None):
+    head = {"Content-Type": content_type, "Content-Length": str(len(body))}
+    head.update(headers or {})
+    writer.write(response_head(status, head))
+    if request.method != "HEAD":
+        writer.write(body)
+    await writer.drain()
+
+
+class FrameSignal:
+    """Wakes coroutines on the event loop whenever the capture thread publishes a frame"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, hub: FrameHub):
+        self.loop = loop
+        self.hub = hub
+        self._event = asyncio.Event()
+        hub.add_listener(self._on_frame)
+
+    def _on_frame(self, sequence: int):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        # swap first so waiters that loop around wait for the frame after this one
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, after: int, timeout: float) -> bool:
+        """Wait for a frame newer than `after`, False on timeout"""
+        while self.hub.latest()[0] <= after:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def close(self):
+        self.hub.remove_listener(self._on_frame)
+
+
+class StreamServer:
+    def __init__(self):
+        self.routes = {
+            "/": self.index,
+            "/video_feed": self.video_feed,
+            "/snapshot.jpg": self.snapshot_jpg,
+            "/clients": self.client_list,
+            "/metrics": self.metrics,
+        }
+        self._signals: Dict[int, FrameSignal] = {}
+        self._index: Optional[bytes] = None
+
+    def signal(self, camera: VideoCamera) -> FrameSignal:
+        signal = self._signals.get(id(camera))
+        if signal is None:
+            signal = self._signals[id(camera)] = FrameSignal(asyncio.get_running_loop(), camera.hub)
+        return signal
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        try:
+            request = await asyncio.wait_for(read_request(reader, peer[0] if peer else None), REQUEST_TIMEOUT)
+            if request is None:
+                return
+            handler = self.routes.get(request.path)
+            if handler is None:
+                await respond(writer, request, 404, b"Not Found")
+            elif request.method not in ("GET", "HEAD"):
+                await respond(writer, request, 405, b"Method Not Allowed", headers={"Allow": "GET, HEAD"})
+            else:
+                await handler(request, writer)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            logging.exception(f"Exception while serving a streamer request: {e!r}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def index(self, request: Request, writer: asyncio.StreamWriter):
+        if self._index is None:
+            # reuse the Flask app's template so both servers serve the same page
+            from flask import render_template
+            from app import flask_app
+
+            with flask_app.test_request_context():
+                self._index = render_template('index.html').encode("utf-8")
+        await respond(writer, request, 200, self._index, "text/html; charset=utf-8")
+
+    async def snapshot_jpg(self, request: Request, writer: asyncio.StreamWriter):
+        # may wait for the camera to wake up, so it runs off the event loop
+        frame = await asyncio.get_running_loop().run_in_executor(None, snapshot, request.query)
+        if frame is None:
+            await respond(writer, request, 503, b"No frame available")
+            return
+        etag = frame_etag(frame)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            writer.write(response_head(304, {"ETag": etag}))
+            await writer.drain()
+            return
+        await respond(writer, request, 200, frame.jpeg, "image/jpeg", {"ETag": etag, "Cache-Control": "no-cache"})
+
+    async def client_list(self, request: Request, writer: asyncio.StreamWriter):
+        body = json.dumps([client.as_dict() for client in clients.clients()]).encode("utf-8")
+        await respond(writer, request, 200, body, "application/json")
+
+    async def metrics(self, request: Request, writer: asyncio.StreamWriter):
+        data = collect_metrics()
+        if request.query.get("format") == "json":
+            await respond(writer, request, 200, json.dumps(data).encode("utf-8"), "application/json")
+        else:
+            await respond(writer, request, 200, prometheus_text(data).encode("utf-8"), PROMETHEUS_MIMETYPE)
+
+    async def video_feed(self, request: Request, writer: asyncio.StreamWriter):
+        writer.write(response_head(200, {"Content-Type": STREAM_MIMETYPE, "Cache-Control": "no-cache"}))
+        await writer.drain()
+        if request.method == "HEAD":
+            return
+
+        # a small send buffer makes a slow link block the send quickly instead of queueing seconds of video
+        connection = writer.get_extra_info("socket")
+        if connection is not None and settings.get("send-buffer"):
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings["send-buffer"])
+
+        camera = get_camera()
+        client = create_client(request.query, request.address, request.target)
+        signal = self.signal(camera)
+        loop = asyncio.get_running_loop()
+        with camera.subscribe(), clients.connected(client):
+            # start from the next frame, the last one may be from before capture was paused
+            sequence = camera.hub.latest()[0]
+            while True:
+                delay = client.adaptive.slot_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                if not await signal.wait(sequence, FRAME_TIMEOUT):
+                    continue
+
+                latest, image, captured = camera.hub.latest()
+                variant = client.adaptive.variant
+                frame = camera.cached(variant)
+                if frame is None or frame.sequence < latest:
+                    # encoding releases the GIL, keep it off the event loop
+                    frame = await loop.run_in_executor(None, camera.encode, latest, image, captured, variant)
+                sequence = frame.sequence
+
+                started = time.monotonic()
+                write_buffers(writer, (frame.header, frame.jpeg, PART_TRAILER))
+                await writer.drain()
+                client.adaptive.sent(started, time.monotonic())
+                client.sent(frame.sequence, len(frame.jpeg), camera.hub.latest()[0])
+
+    def close(self):
+        for signal in self._signals.values():
+            signal.close()
+
+
+async def serve(host: str, port: int):
+    server = StreamServer()
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER_SIZE, reuse_address=True)
+    logging.info(f"Streamer listening on {host}:{port} (asyncio)")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def run(host: str = '0.0.0.0', port: int = 5000):
+    asyncio.run(serve(host, port))
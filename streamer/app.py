@@ -1,6 +1,12 @@
+import time
+import socket
 
-from flask import Flask, render_template, Response
-from camera import VideoCamera
+from flask import Flask, render_template, Response, request, jsonify
+
+from metrics import PROMETHEUS_MIMETYPE, prometheus_text
+from multipart import PART_TRAILER, STREAM_MIMETYPE
+from stream import (FRAME_TIMEOUT, clients, collect_metrics, create_client, etag_matches, frame_etag,
+                    get_camera, settings, snapshot, start_diagnostics, start_recorder)
 
 flask_app = Flask(__name__)
 
@@ -8,20 +14,68 @@ flask_app = Flask(__name__)
 def index():
     return render_template('index.html')
 
-def gen(camera):
-    while True:
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+def gen(camera, client):
+    with camera.subscribe(), clients.connected(client):
+        # start from the next frame, the last one may be from before capture was paused
+        sequence = camera.hub.latest()[0]
+        while True:
+            client.adaptive.wait_for_slot()
+            # clients only ever see the newest frame, a slow client skips frames instead of stalling capture
+            frame = camera.wait_encoded(sequence, client.adaptive.variant, FRAME_TIMEOUT)
+            if frame is None:
+                continue
+            sequence = frame.sequence
+            started = time.monotonic()
+            # separate chunks so the shared JPEG bytes are written as they are, without a per-client copy
+            yield frame.header
+            yield frame.jpeg
+            yield PART_TRAILER
+            # the generator resumes once the server has written the part out
+            client.adaptive.sent(started, time.monotonic())
+            client.sent(frame.sequence, len(frame.jpeg), camera.hub.latest()[0])
 
 @flask_app.route('/video_feed')
 def video_feed():
-    return Response(gen(VideoCamera()),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    client = create_client(request.args, request.remote_addr, request.full_path.rstrip("?"))
+    # a small send buffer makes a slow link block the send quickly instead of queueing seconds of video
+    connection = request.environ.get("werkzeug.socket")
+    if connection is not None and settings.get("send-buffer"):
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings["send-buffer"])
+    return Response(gen(get_camera(), client), mimetype=STREAM_MIMETYPE)
+
+@flask_app.route('/snapshot.jpg')
+def snapshot_jpg():
+    # e.g. /snapshot.jpg?max_age=5 lets polling clients reuse a frame up to 5s old
+    frame = snapshot(request.args)
+    if frame is None:
+        return Response("No frame available", status=503, mimetype="text/plain")
+    etag = frame_etag(frame)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers={"ETag": etag})
+    return Response(frame.jpeg, mimetype="image/jpeg", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@flask_app.route('/clients')
+def client_list():
+    return jsonify([client.as_dict() for client in clients.clients()])
+
+@flask_app.route('/metrics')
+def metrics():
+    # Prometheus text by default, /metrics?format=json for the same data as JSON
+    data = collect_metrics()
+    if request.args.get("format") == "json":
+        return jsonify(data)
+    return Response(prometheus_text(data), content_type=PROMETHEUS_MIMETYPE)
 
 
 def run():
-    flask_app.run(host='0.0.0.0', debug=False)
+    start_diagnostics()
+    start_recorder()
+    if settings.get("server", "flask") == "asyncio":
+        import aio_server
+
+        aio_server.run('0.0.0.0', settings["port"])
+    else:
+        flask_app.run(host='0.0.0.0', port=settings["port"], debug=False, threaded=True)
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
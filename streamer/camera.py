@@ -1,15 +1,246 @@
+"""
+Kevinbot v3 streamer camera
+One capture thread per camera source, publishing the latest frame to every client through a hub
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
 import cv2
+import numpy as np
+
+from metrics import CameraMetrics
+from motion import MotionGate
+from multipart import part_header
+
+# seconds to wait before reopening a camera that stopped delivering frames
+REOPEN_DELAY = 1.0
+
+Source = Union[int, str]
+
+
+@dataclass(frozen=True)
+class Variant:
+    """One rung of the quality ladder, frames are shared between clients on the same scale and quality"""
+    name: str
+    scale: float = 1.0
+    quality: int = 80
+    fps: float = 30.0
+
+    @property
+    def key(self) -> Tuple[float, int]:
+        return self.scale, self.quality
+
+
+DEFAULT_VARIANT = Variant("default")
+
+
+@dataclass(frozen=True)
+class EncodedFrame:
+    sequence: int
+    variant: Variant
+    jpeg: bytes
+    captured: float  # monotonic capture time
+    header: bytes  # multipart part header, built once per encode and shared by every client
+
+
+class FrameHub:
+    """Holds the newest frame, readers wait for one newer than the last they saw"""
 
-class VideoCamera(object):
     def __init__(self):
-        #self.video = cv2.VideoCapture(r"libcamerasrc ! video/x-raw, width=640, height=480, framerate=24/1 ! videoconvert ! videoscale ! appsink", cv2.CAP_GSTREAMER)
-        self.video = cv2.VideoCapture(0)
-        
-    def __del__(self):
-        self.video.release()
-    
-    def get_frame(self):
-        success, image = self.video.read()
-        ret, jpeg = cv2.imencode('.jpg', image)
-        return jpeg.tobytes()
+        self._condition = threading.Condition()
+        self._frame: Optional[np.ndarray] = None
+        self._sequence = 0
+        # monotonic capture time of the newest frame
+        self._captured = 0.0
+        # called with the new sequence from the capture thread, for waiters that can't block on the condition
+        self._listeners: List[Callable[[int], None]] = []
+
+    def publish(self, frame: np.ndarray, captured: Optional[float] = None):
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self._captured = time.monotonic() if captured is None else captured
+            sequence = self._sequence
+            self._condition.notify_all()
+        for listener in list(self._listeners):
+            listener(sequence)
+
+    def add_listener(self, listener: Callable[[int], None]):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[int], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def latest(self) -> Tuple[int, Optional[np.ndarray], float]:
+        """The newest (sequence, frame, monotonic capture time)"""
+        with self._condition:
+            return self._sequence, self._frame, self._captured
+
+    def wait(self, after: int = 0, timeout: Optional[float] = None) -> Tuple[int, Optional[np.ndarray], float]:
+        """Block until a frame newer than sequence `after` exists, returns the newest (sequence, frame, captured)"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > after, timeout)
+            return self._sequence, self._frame, self._captured
+
+
+class VideoCamera(object):
+    _cameras: Dict[Source, "VideoCamera"] = {}
+    _cameras_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, source: Source = 0, idle_timeout: float = 5.0) -> "VideoCamera":
+        """The running camera for a source, every client of the same device gets the same instance"""
+        with cls._cameras_lock:
+            camera = cls._cameras.get(source)
+            if camera is None:
+                camera = cls._cameras[source] = cls(source, idle_timeout)
+            camera.start()
+            return camera
+
+    @classmethod
+    def cameras(cls) -> List["VideoCamera"]:
+        with cls._cameras_lock:
+            return list(cls._cameras.values())
+
+    def __init__(self, source: Source = 0, idle_timeout: float = 5.0):
+        #self.source = r"libcamerasrc ! video/x-raw, width=640, height=480, framerate=24/1 ! videoconvert ! videoscale ! appsink"
+        self.source = source
+        # the device stays open this long after the last viewer leaves so a reconnect is instant
+        self.idle_timeout = idle_timeout
+        self.hub = FrameHub()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._subscribers = 0
+        self._subscribers_changed = threading.Condition()
+        # newest encode per scale and quality, shared by every client asking for it
+        self._encoded: Dict[Tuple[float, int], EncodedFrame] = {}
+        self._encode_locks: Dict[Tuple[float, int], threading.Lock] = {}
+        self.metrics = CameraMetrics()
+        # drops frames while the scene is still, so encodes and sends slow down with it
+        self.motion: Optional[MotionGate] = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name=f"camera-{self.source}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._subscribers_changed:
+            self._running = False
+            self._subscribers_changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def subscribe(self):
+        """Capture runs while at least one subscription is open"""
+        with self._subscribers_changed:
+            self._subscribers += 1
+            self._subscribers_changed.notify_all()
+        try:
+            yield self
+        finally:
+            with self._subscribers_changed:
+                self._subscribers -= 1
+                self._subscribers_changed.notify_all()
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def _open(self) -> cv2.VideoCapture:
+        if isinstance(self.source, str) and "!" in self.source:
+            return cv2.VideoCapture(self.source, cv2.CAP_GSTREAMER)
+        return cv2.VideoCapture(self.source)
+
+    def _wait_for_subscribers(self, video: Optional[cv2.VideoCapture]) -> bool:
+        """Pause while nobody is watching, returns False when the camera should stay closed"""
+        with self._subscribers_changed:
+            if self._subscribers:
+                return True
+            self._subscribers_changed.wait_for(lambda: self._subscribers or not self._running,
+                                               self.idle_timeout if video is not None else None)
+            return bool(self._subscribers) and self._running
+
+    def _capture_loop(self):
+        video = None
+        try:
+            while self._running:
+                if not self._wait_for_subscribers(video):
+                    if video is not None:
+                        logging.info(f"No viewers on camera {self.source}, closing it")
+                        video.release()
+                        video = None
+                        self.metrics.closed()
+                    continue
+
+                if video is None:
+                    logging.info(f"Opening camera {self.source}")
+                    video = self._open()
+                    self.metrics.opened()
+                    if self.motion is not None:
+                        self.motion.reset()
+                started = time.monotonic()
+                success, image = video.read()
+                finished = time.monotonic()
+                if not success:
+                    logging.warning(f"Camera {self.source} returned no frame, reopening")
+                    video.release()
+                    video = None
+                    self.metrics.read_failed()
+                    self.metrics.closed()
+                    time.sleep(REOPEN_DELAY)
+                    continue
+                self.metrics.captured(started, finished)
+                if self.motion is not None and not self.motion.admit(image):
+                    self.metrics.frame_gated()
+                    continue
+                self.hub.publish(image, finished)
+        finally:
+            if video is not None:
+                video.release()
+                self.metrics.closed()
+
+    def encode(self, sequence: int, image: np.ndarray, captured: float,
+               variant: Variant = DEFAULT_VARIANT) -> EncodedFrame:
+        """JPEG for a frame, each frame is encoded at most once per variant no matter how many clients ask"""
+        lock = self._encode_locks.setdefault(variant.key, threading.Lock())
+        with lock:
+            cached = self._encoded.get(variant.key)
+            if cached is not None and cached.sequence >= sequence:
+                self.metrics.encode_reused()
+                return cached
+            started = time.monotonic()
+            if variant.scale != 1.0:
+                image = cv2.resize(image, None, fx=variant.scale, fy=variant.scale, interpolation=cv2.INTER_AREA)
+            ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, variant.quality])
+            jpeg = jpeg.tobytes()
+            self.metrics.encoded(variant.name, time.monotonic() - started)
+            cached = EncodedFrame(sequence, variant, jpeg, captured, part_header(len(jpeg)))
+            self._encoded[variant.key] = cached
+            return cached
+
+    def cached(self, variant: Variant = DEFAULT_VARIANT) -> Optional[EncodedFrame]:
+        """Newest encode for a variant without encoding anything"""
+        return self._encoded.get(variant.key)
+
+    def wait_encoded(self, after: int = 0, variant: Variant = DEFAULT_VARIANT,
+                     timeout: Optional[float] = None) -> Optional[EncodedFrame]:
+        """The newest frame after sequence `after` as JPEG, None on timeout"""
+        sequence, image, captured = self.hub.wait(after, timeout)
+        if image is None or sequence <= after:
+            return None
+        return self.encode(sequence, image, captured, variant)
 
+    def get_frame(self) -> bytes:
+        with self.subscribe():
+            return self.wait_encoded(self.hub.latest()[0]).jpeg
@@ -0,0 +1,108 @@
+"""
+Kevinbot v3 streamer clients
+Per-client delivery counters and the registry of connected streaming clients
+"""
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from adaptive import AdaptiveClient
+
+_ids = itertools.count(1)
+
+
+class StreamClient:
+    """
+    Counts what one viewer received. Clients only ever get the newest frame, so every frame
+    that is not sent is skipped: `skipped_slow` arrived while the client was still sending the
+    previous one, `skipped_paced` were dropped to hold the client's frame rate.
+    """
+
+    def __init__(self, adaptive: AdaptiveClient, address: Optional[str] = None, path: str = ""):
+        self.id = next(_ids)
+        self.adaptive = adaptive
+        self.address = address
+        self.path = path
+        self.connected = time.time()
+        self.frames = 0
+        self.bytes = 0
+        self.skipped_slow = 0
+        self.skipped_paced = 0
+        self.last_sequence = 0
+        self._arrived_while_sending = 0
+
+    @property
+    def skipped(self) -> int:
+        return self.skipped_slow + self.skipped_paced
+
+    def sent(self, sequence: int, size: int, newest_sequence: int):
+        """Record a sent frame, `newest_sequence` is the hub's sequence once the send finished"""
+        if self.last_sequence:
+            gap = max(0, sequence - self.last_sequence - 1)
+            slow = min(gap, self._arrived_while_sending)
+            self.skipped_slow += slow
+            self.skipped_paced += gap - slow
+        self._arrived_while_sending = max(0, newest_sequence - sequence)
+        self.last_sequence = sequence
+        self.frames += 1
+        self.bytes += size
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "address": self.address,
+            "path": self.path,
+            "connected": round(self.connected, 3),
+            "variant": self.adaptive.variant.name,
+            "load": round(self.adaptive.load, 3),
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "skipped": self.skipped,
+            "skipped_slow": self.skipped_slow,
+            "skipped_paced": self.skipped_paced,
+        }
+
+
+COUNTERS = ("frames", "bytes", "skipped_slow", "skipped_paced")
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._clients: Dict[int, StreamClient] = {}
+        self._lock = threading.Lock()
+        self.connections = 0
+        # counters of clients that have left, so totals don't drop when someone disconnects
+        self._departed = dict.fromkeys(COUNTERS, 0)
+
+    @contextmanager
+    def connected(self, client: StreamClient):
+        with self._lock:
+            self._clients[client.id] = client
+            self.connections += 1
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._clients.pop(client.id, None)
+                for counter in COUNTERS:
+                    self._departed[counter] += getattr(client, counter)
+
+    def clients(self) -> List[StreamClient]:
+        with self._lock:
+            return list(self._clients.values())
+
+    def totals(self) -> dict:
+        """Counters summed over every client since startup, connected or not"""
+        with self._lock:
+            totals = dict(self._departed)
+            for client in self._clients.values():
+                for counter in COUNTERS:
+                    totals[counter] += getattr(client, counter)
+            totals["connections"] = self.connections
+        return totals
+
+    def __len__(self):
+        return len(self._clients)
@@ -0,0 +1,239 @@
+"""
+Kevinbot v3 streamer metrics
+Capture and encode timing, camera open/close counts and per-client delivery, as JSON, Prometheus text or MQTT
+"""
+
+import bisect
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from typing import Callable, Dict, List, Optional, Sequence
+
+from paho.mqtt import client as mqtt_client
+
+# bucket edges for a camera read, in seconds, a read blocks until the next frame so this is the frame interval
+CAPTURE_EDGES = (0.005, 0.01, 0.02, 0.033, 0.05, 0.067, 0.1, 0.2, 0.5, 1.0)
+# bucket edges for resizing and JPEG encoding one frame, in seconds
+ENCODE_EDGES = (0.001, 0.002, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.2)
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Counts per bucket between fixed edges with a running sum, the last bucket is open ended"""
+
+    def __init__(self, edges: Sequence[float]):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # encodes for different variants run on different client threads
+        self._lock = threading.Lock()
+
+    def add(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.edges, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"edges": list(self.edges), "counts": list(self.counts),
+                    "sum": round(self.sum, 6), "count": self.count}
+
+
+@dataclass
+class CameraMetrics:
+    opens: int = 0
+    closes: int = 0
+    read_failures: int = 0
+    frames: int = 0
+    # frames captured but not published because the scene was still
+    gated: int = 0
+    fps: float = 0.0
+    # encode requests answered from the shared cache instead of encoding again
+    encodes_reused: int = 0
+    capture: Histogram = dataclass_field(default_factory=lambda: Histogram(CAPTURE_EDGES))
+    encode: Dict[str, Histogram] = dataclass_field(default_factory=dict)
+    fps_alpha: float = 0.1
+    _last_frame: Optional[float] = None
+    # counters are bumped from the capture thread and from every client thread that encodes
+    _lock: threading.Lock = dataclass_field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def opened(self):
+        with self._lock:
+            self.opens += 1
+
+    def read_failed(self):
+        with self._lock:
+            self.read_failures += 1
+
+    def frame_gated(self):
+        with self._lock:
+            self.gated += 1
+
+    def encode_reused(self):
+        with self._lock:
+            self.encodes_reused += 1
+
+    def captured(self, started: float, finished: float):
+        self.capture.add(finished - started)
+        with self._lock:
+            self.frames += 1
+            if self._last_frame is not None and finished > self._last_frame:
+                self.fps += self.fps_alpha * (1 / (finished - self._last_frame) - self.fps)
+            self._last_frame = finished
+
+    def closed(self):
+        with self._lock:
+            self.closes += 1
+            # the gap until the next open is not a frame interval
+            self._last_frame = None
+
+    def encoded(self, variant: str, seconds: float):
+        histogram = self.encode.get(variant)
+        if histogram is None:
+            histogram = self.encode.setdefault(variant, Histogram(ENCODE_EDGES))
+        histogram.add(seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            counters = {
+                "opens": self.opens,
+                "closes": self.closes,
+                "read_failures": self.read_failures,
+                "frames": self.frames,
+                "gated": self.gated,
+                "fps": round(self.fps, 2),
+                "encodes_reused": self.encodes_reused,
+            }
+        return {
+            **counters,
+            "capture": self.capture.as_dict(),
+            "encode": {variant: histogram.as_dict() for variant, histogram in list(self.encode.items())},
+        }
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _PrometheusWriter:
+    def __init__(self):
+        self.lines: List[str] = []
+        self._described = set()
+
+    def describe(self, name: str, kind: str, help_text: str):
+        if name not in self._described:
+            self._described.add(name)
+            self.lines.append(f"# HELP {name} {help_text}")
+            self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name: str, value, **labels):
+        self.lines.append(f"{name}{_labels(**labels) if labels else ''} {value}")
+
+    def histogram(self, name: str, histogram: dict, **labels):
+        cumulative = 0
+        for edge, count in zip(histogram["edges"], histogram["counts"]):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, **labels, le=edge)
+        self.sample(f"{name}_bucket", histogram["count"], **labels, le="+Inf")
+        self.sample(f"{name}_sum", histogram["sum"], **labels)
+        self.sample(f"{name}_count", histogram["count"], **labels)
+
+
+def prometheus_text(metrics: dict) -> str:
+    """Render the output of `stream.collect_metrics` in the Prometheus text exposition format"""
+    out = _PrometheusWriter()
+    counters = [
+        ("opens", "streamer_camera_opens_total", "Times the camera device was opened"),
+        ("closes", "streamer_camera_closes_total", "Times the camera device was released"),
+        ("read_failures", "streamer_camera_read_failures_total", "Camera reads that returned no frame"),
+        ("frames", "streamer_camera_frames_total", "Frames captured"),
+        ("gated", "streamer_camera_gated_frames_total", "Frames dropped because the scene was still"),
+        ("encodes_reused", "streamer_encodes_reused_total", "Encode requests served from the shared cache"),
+    ]
+    for key, name, help_text in counters:
+        out.describe(name, "counter", help_text)
+        for source, camera in metrics["cameras"].items():
+            out.sample(name, camera[key], source=source)
+
+    # every family's HELP, TYPE and samples have to stay together
+    out.describe("streamer_camera_fps", "gauge", "Smoothed capture frame rate")
+    for source, camera in metrics["cameras"].items():
+        out.sample("streamer_camera_fps", camera["fps"], source=source)
+    out.describe("streamer_camera_subscribers", "gauge", "Clients currently subscribed to the camera")
+    for source, camera in metrics["cameras"].items():
+        out.sample("streamer_camera_subscribers", camera["subscribers"], source=source)
+    stills = {source: camera["still"] for source, camera in metrics["cameras"].items() if "still" in camera}
+    if stills:
+        out.describe("streamer_camera_still", "gauge", "1 while the motion gate considers the scene still")
+        for source, still in stills.items():
+            out.sample("streamer_camera_still", int(still), source=source)
+
+    out.describe("streamer_capture_seconds", "histogram", "Time spent in each camera read")
+    for source, camera in metrics["cameras"].items():
+        out.histogram("streamer_capture_seconds", camera["capture"], source=source)
+    out.describe("streamer_encode_seconds", "histogram", "Time to resize and JPEG encode one frame")
+    for source, camera in metrics["cameras"].items():
+        for variant, histogram in camera["encode"].items():
+            out.histogram("streamer_encode_seconds", histogram, source=source, variant=variant)
+
+    totals = metrics["totals"]
+    out.describe("streamer_connections_total", "counter", "Streaming clients that have connected")
+    out.sample("streamer_connections_total", totals["connections"])
+    out.describe("streamer_clients", "gauge", "Streaming clients currently connected")
+    out.sample("streamer_clients", len(metrics["clients"]))
+    out.describe("streamer_sent_frames_total", "counter", "Frames sent to all clients")
+    out.sample("streamer_sent_frames_total", totals["frames"])
+    out.describe("streamer_sent_bytes_total", "counter", "JPEG bytes sent to all clients")
+    out.sample("streamer_sent_bytes_total", totals["bytes"])
+    out.describe("streamer_skipped_frames_total", "counter", "Frames not sent to clients")
+    out.sample("streamer_skipped_frames_total", totals["skipped_slow"], reason="slow")
+    out.sample("streamer_skipped_frames_total", totals["skipped_paced"], reason="paced")
+
+    # per-client ids and addresses would be unbounded label values, those stay in the JSON view
+    variants: Dict[str, List[float]] = {}
+    for client in metrics["clients"]:
+        variants.setdefault(client["variant"], []).append(client["load"])
+    out.describe("streamer_variant_clients", "gauge", "Streaming clients currently on each quality variant")
+    for variant, loads in sorted(variants.items()):
+        out.sample("streamer_variant_clients", len(loads), variant=variant)
+    out.describe("streamer_variant_max_load", "gauge", "Highest client send load on each quality variant")
+    for variant, loads in sorted(variants.items()):
+        out.sample("streamer_variant_max_load", max(loads), variant=variant)
+    return "\n".join(out.lines) + "\n"
+
+
+class DiagnosticsPublisher:
+    """Publishes collected metrics as JSON to an MQTT topic every `interval` seconds"""
+
+    def __init__(self, client: mqtt_client.Client, collect: Callable[[], dict], topic: str, interval: float):
+        self.client = client
+        self.collect = collect
+        self.topic = topic
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="streamer-diagnostics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.client.publish(self.topic, json.dumps(self.collect()))
+            except Exception as e:
+                logging.warning(f"Failed to publish streamer diagnostics: {e!r}")
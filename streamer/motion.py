@@ -0,0 +1,90 @@
+"""
+Kevinbot v3 streamer motion gate
+Drops frames while the scene is still, comparing a strided single channel copy with the last frame published
+"""
+
+import logging
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+class MotionGate:
+    """
+    A frame moved if more than `threshold` of its sampled pixels changed by over `pixel_threshold`.
+    After `still_after` seconds without motion only `still_fps` frames per second pass, the first
+    frame that moves passes straight away.
+    """
+
+    def __init__(self, step: int = 8, pixel_threshold: int = 25, threshold: float = 0.01,
+                 still_after: float = 2.0, still_fps: float = 2.0):
+        self.step = step
+        self.pixel_threshold = pixel_threshold
+        self.threshold = threshold
+        self.still_after = still_after
+        self.still_interval = 1 / still_fps
+        self.still = False
+        # fraction of sampled pixels that changed in the last frame
+        self.score = 0.0
+        self.changes = 0
+        # called with (still, score) from the capture thread when the state flips
+        self.listeners: List[Callable[[bool, float], None]] = []
+
+        # the last admitted frame, comparing against it lets slow changes add up while frames are dropped
+        self._reference: Optional[np.ndarray] = None
+        self._last_motion = 0.0
+        self._last_admitted = 0.0
+
+    @classmethod
+    def from_settings(cls, motion_settings: dict):
+        return cls(step=motion_settings.get("step", 8),
+                   pixel_threshold=motion_settings.get("pixel-threshold", 25),
+                   threshold=motion_settings.get("threshold", 0.01),
+                   still_after=motion_settings.get("still-after", 2.0),
+                   still_fps=motion_settings.get("still-fps", 2.0))
+
+    def reset(self):
+        """Forget the reference frame, e.g. after the camera was reopened"""
+        self._reference = None
+
+    def admit(self, image: np.ndarray, now: Optional[float] = None) -> bool:
+        """Whether a captured frame should be published"""
+        if now is None:
+            now = time.monotonic()
+        # the green channel is close enough to luma for change detection and needs no conversion
+        sample = image[::self.step, ::self.step, 1] if image.ndim == 3 else image[::self.step, ::self.step]
+        sample = sample.astype(np.int16)
+        reference = self._reference
+        if reference is None or reference.shape != sample.shape:
+            # nothing to compare against yet, pass the frame without calling it motion
+            self._reference = sample
+            self._last_admitted = now
+            if not self.still:
+                self._last_motion = now
+            return True
+        self.score = float(np.count_nonzero(np.abs(sample - reference) > self.pixel_threshold)) / sample.size
+
+        if self.score > self.threshold:
+            self._last_motion = now
+            self._set_still(False)
+        elif now - self._last_motion >= self.still_after:
+            self._set_still(True)
+
+        if self.still and now - self._last_admitted < self.still_interval:
+            return False
+        self._reference = sample
+        self._last_admitted = now
+        return True
+
+    def _set_still(self, still: bool):
+        if still == self.still:
+            return
+        self.still = still
+        self.changes += 1
+        for listener in list(self.listeners):
+            # listeners run on the capture thread, one failing must not stop capture
+            try:
+                listener(still, self.score)
+            except Exception:
+                logging.exception("Motion listener failed")
@@ -0,0 +1,15 @@
+"""
+Kevinbot v3 streamer multipart framing
+MJPEG parts are written as a precomputed header, the shared JPEG bytes and a trailer, never concatenated
+"""
+
+BOUNDARY = "frame"
+STREAM_MIMETYPE = f"multipart/x-mixed-replace; boundary={BOUNDARY}"
+PART_TRAILER = b"\r\n"
+
+
+def part_header(length: int, content_type: str = "image/jpeg") -> bytes:
+    # Content-Length lets clients read the part in one go instead of scanning for the boundary
+    return (f"--{BOUNDARY}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {length}\r\n\r\n").encode("ascii")
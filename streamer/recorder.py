@@ -0,0 +1,281 @@
+"""
+Kevinbot v3 streamer recorder
+Writes the shared JPEG encodes to raw MJPEG segments in a ring of bounded size, an estop pins the segments around it
+"""
+
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+from camera import Variant, VideoCamera
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+EXTENSION = ".mjpg"
+INDEX_EXTENSION = ".idx"
+PINNED_DIRECTORY = "pinned"
+
+# one record per frame: wall clock capture time, byte offset and size of the JPEG in the segment
+INDEX_DTYPE = np.dtype([("t", "<f8"), ("offset", "<u8"), ("size", "<u4")])
+
+
+@dataclass
+class Segment:
+    path: str
+    start: float
+    end: float
+    size: int
+
+    @property
+    def index_path(self) -> str:
+        return index_path(self.path)
+
+
+def index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + INDEX_EXTENSION
+
+
+def resolve_directory(directory: str) -> str:
+    """Directories from settings are relative to the install, like the sensor logs, not the working directory"""
+    return os.path.normpath(os.path.join(CURRENT_DIR, "..", directory))
+
+
+def read_index(path: str) -> np.ndarray:
+    """
+    Frame index of a segment, empty if the segment has no frames yet. After a crash the last record
+    can be cut short or point past the end of the video, those frames are left out.
+    """
+    try:
+        with open(index_path(path), "rb") as f:
+            data = f.read()
+        video_size = os.path.getsize(path)
+    except FileNotFoundError:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    index = np.frombuffer(data, dtype=INDEX_DTYPE, count=len(data) // INDEX_DTYPE.itemsize)
+    return index[index["offset"] + index["size"] <= video_size]
+
+
+def segment_paths(directory: str) -> List[str]:
+    # names sort chronologically: video-date-time-sequence
+    return sorted(glob.glob(os.path.join(directory, f"video-*{EXTENSION}")))
+
+
+def load_segment(path: str) -> Optional[Segment]:
+    index = read_index(path)
+    if not len(index):
+        return None
+    return Segment(path, float(index["t"][0]), float(index["t"][-1]), os.path.getsize(path))
+
+
+def find_segments(directory: str, start: float, end: float) -> List[Segment]:
+    """Ring and pinned segments with frames between wall clock times start and end, oldest first"""
+    paths = segment_paths(directory) + segment_paths(os.path.join(directory, PINNED_DIRECTORY))
+    segments = [segment for segment in map(load_segment, paths) if segment is not None]
+    return sorted((segment for segment in segments if segment.end >= start and segment.start <= end),
+                  key=lambda segment: segment.start)
+
+
+def read_frame(path: str, record: np.void) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(int(record["offset"]))
+        return f.read(int(record["size"]))
+
+
+class SegmentWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.size = 0
+        self._video = open(path, "wb")
+        self._index = open(index_path(path), "wb")
+
+    def write(self, timestamp: float, jpeg: bytes):
+        record = np.array([(timestamp, self.size, len(jpeg))], dtype=INDEX_DTYPE)
+        self._video.write(jpeg)
+        self._index.write(record.tobytes())
+        self.size += len(jpeg)
+        if self.start is None:
+            self.start = timestamp
+        self.end = timestamp
+
+    def close(self) -> Segment:
+        self._video.close()
+        self._index.close()
+        return Segment(self.path, self.start or 0.0, self.end or 0.0, self.size)
+
+
+class VideoRecorder:
+    """
+    Records one variant of a camera. Frames come from the camera's shared encode cache, so when
+    viewers already get this variant the recorder only writes bytes that were encoded for them.
+    The camera stays open while recording.
+    """
+
+    def __init__(self, camera: VideoCamera, directory: str, variant: Variant, fps: float = 10.0,
+                 segment_seconds: float = 30.0, max_bytes: int = 512 * 1024 * 1024,
+                 max_pinned_bytes: int = 2048 * 1024 * 1024, pin_before: float = 30.0, pin_after: float = 30.0):
+        self.camera = camera
+        self.directory = directory
+        self.pinned_directory = os.path.join(directory, PINNED_DIRECTORY)
+        self.variant = variant
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        # pinned segments have their own, larger limit, oldest go first
+        self.max_pinned_bytes = max_pinned_bytes
+        self.pin_before = pin_before
+        self.pin_after = pin_after
+
+        self._segments: List[Segment] = []
+        self._writer: Optional[SegmentWriter] = None
+        self._sequence = 0
+        # segments starting before this wall clock time get pinned when they close
+        self._pin_until = 0.0
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+        os.makedirs(self.pinned_directory, exist_ok=True)
+        for path in segment_paths(directory):
+            segment = load_segment(path)
+            if segment is not None:
+                self._segments.append(segment)
+        # the limits may have shrunk since the last run
+        self._trim()
+        self._trim_pinned()
+
+    @classmethod
+    def from_settings(cls, camera: VideoCamera, record_settings: dict, ladder: List[Variant]):
+        names = {variant.name: variant for variant in ladder}
+        return cls(camera, resolve_directory(record_settings.get("directory", "logs/video")),
+                   names.get(record_settings.get("variant"), ladder[0]),
+                   fps=record_settings.get("fps", 10.0),
+                   segment_seconds=record_settings.get("segment-seconds", 30.0),
+                   max_bytes=int(record_settings.get("max-size-mb", 512) * 1024 * 1024),
+                   max_pinned_bytes=int(record_settings.get("max-pinned-mb", 2048) * 1024 * 1024),
+                   pin_before=record_settings.get("pin-before", 30.0),
+                   pin_after=record_settings.get("pin-after", 30.0))
+
+    @property
+    def size(self) -> int:
+        """Bytes used by the ring, pinned segments don't count against the limit"""
+        with self._lock:
+            return sum(segment.size for segment in self._segments) + (self._writer.size if self._writer else 0)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="video-recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._close_segment()
+
+    def pin(self, timestamp: Optional[float] = None):
+        """Keep the segments from pin_before seconds before `timestamp` to pin_after seconds after it"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._pin_until = max(self._pin_until, timestamp + self.pin_after)
+            for segment in [segment for segment in self._segments if segment.end >= timestamp - self.pin_before]:
+                self._move_to_pinned(segment)
+            self._trim_pinned()
+        logging.info(f"Pinned recording around {time.strftime('%H:%M:%S', time.localtime(timestamp))}")
+
+    def _run(self):
+        interval = 1 / self.fps
+        next_frame = 0.0
+        with self.camera.subscribe():
+            sequence = self.camera.hub.latest()[0]
+            while self._running:
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                frame = self.camera.wait_encoded(sequence, self.variant, 1.0)
+                if frame is None:
+                    continue
+                sequence = frame.sequence
+                next_frame = max(next_frame, time.monotonic() - interval) + interval
+                # the index is wall clock so recordings line up with estops and other services' logs
+                timestamp = time.time() - (time.monotonic() - frame.captured)
+                with self._lock:
+                    self._write(timestamp, frame.jpeg)
+
+    def _write(self, timestamp: float, jpeg: bytes):
+        if self._writer is not None and timestamp - self._writer.start >= self.segment_seconds:
+            self._close_segment()
+        if self._writer is None:
+            name = f"video-{time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))}-{self._sequence:04d}{EXTENSION}"
+            self._sequence += 1
+            self._writer = SegmentWriter(os.path.join(self.directory, name))
+        self._writer.write(timestamp, jpeg)
+
+    def _close_segment(self):
+        if self._writer is None:
+            return
+        segment = self._writer.close()
+        self._writer = None
+        if segment.start <= self._pin_until:
+            self._move_to_pinned(segment, listed=False)
+            self._trim_pinned()
+        else:
+            self._segments.append(segment)
+        self._trim()
+
+    def _move_to_pinned(self, segment: Segment, listed: bool = True):
+        for path in (segment.path, segment.index_path):
+            shutil.move(path, os.path.join(self.pinned_directory, os.path.basename(path)))
+        if listed:
+            self._segments.remove(segment)
+
+    def _trim(self):
+        # oldest unpinned segments go first, the segment being written is never removed
+        total = sum(segment.size for segment in self._segments)
+        while self._segments and total > self.max_bytes:
+            segment = self._segments.pop(0)
+            total -= segment.size
+            _remove_segment(segment.path)
+
+    def _trim_pinned(self):
+        paths = segment_paths(self.pinned_directory)
+        sizes = [_segment_size(path) for path in paths]
+        total = sum(sizes)
+        for path, size in zip(paths, sizes):
+            if total <= self.max_pinned_bytes:
+                break
+            logging.warning(f"Pinned recordings are over {self.max_pinned_bytes // (1024 * 1024)}MB, "
+                            f"removing {os.path.basename(path)}")
+            _remove_segment(path)
+            total -= size
+
+
+def _segment_size(path: str) -> int:
+    size = 0
+    for part in (path, index_path(path)):
+        try:
+            size += os.path.getsize(part)
+        except OSError:
+            pass
+    return size
+
+
+def _remove_segment(path: str):
+    for part in (path, index_path(path)):
+        try:
+            os.remove(part)
+        except OSError:
+            pass
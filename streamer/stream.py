@@ -0,0 +1,193 @@
+"""
+Kevinbot v3 streamer shared state
+Settings, the quality ladder and connected clients, used by both the Flask and asyncio servers
+"""
+
+import os
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from typing import Callable, List, Mapping, Optional
+
+from paho.mqtt import client as mqtt_client
+
+from adaptive import AdaptiveClient, cap_ladder, ladder_from_settings
+from camera import EncodedFrame, VideoCamera
+from clients import ClientRegistry, StreamClient
+from metrics import DiagnosticsPublisher
+from motion import MotionGate
+from recorder import VideoRecorder
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+SETTINGS_PATH = os.path.join(CURRENT_DIR, '..', 'settings.json')
+
+services = json.load(open(SETTINGS_PATH, 'r'))["services"]
+settings = services["streamer"]
+
+# how long a client waits for a frame before checking the camera again
+FRAME_TIMEOUT = 1.0
+# how long a snapshot request waits for the camera to produce a frame
+SNAPSHOT_TIMEOUT = 5.0
+# frame sequences restart with the process, so ETags carry a per-process token
+_ETAG_PREFIX = uuid.uuid4().hex[:8]
+
+ladder = ladder_from_settings(settings)
+clients = ClientRegistry()
+recorder: Optional[VideoRecorder] = None
+
+_camera_setup_lock = threading.Lock()
+_mqtt: Optional[mqtt_client.Client] = None
+_mqtt_topics: List[str] = []
+
+
+def get_camera() -> VideoCamera:
+    camera = VideoCamera.shared(settings["source"], settings.get("idle-timeout", 5.0))
+    motion_settings = settings.get("motion", {})
+    if motion_settings.get("enabled") and camera.motion is None:
+        with _camera_setup_lock:
+            if camera.motion is None:
+                camera.motion = create_motion_gate(motion_settings)
+    return camera
+
+
+def create_motion_gate(motion_settings: dict) -> MotionGate:
+    gate = MotionGate.from_settings(motion_settings)
+    if motion_settings.get("topic"):
+        def on_change(still: bool, score: float):
+            get_mqtt().publish(motion_settings["topic"],
+                               json.dumps({"motion": not still, "score": round(score, 4), "t": time.time()}))
+
+        gate.listeners.append(on_change)
+    return gate
+
+
+def _query_value(query: Mapping[str, str], key: str, kind: Callable):
+    try:
+        value = kind(query[key]) if key in query else None
+    except ValueError:
+        return None
+    # nan and inf parse as floats but mean nothing as a cap
+    return value if value is None or math.isfinite(value) else None
+
+
+def create_client(query: Mapping[str, str], address: Optional[str], path: str) -> StreamClient:
+    # optional caps, e.g. /video_feed?level=medium&fps=10
+    client_ladder = cap_ladder(ladder,
+                               level=query.get("level"),
+                               quality=_query_value(query, "quality", int),
+                               scale=_query_value(query, "scale", float),
+                               fps=_query_value(query, "fps", float))
+    return StreamClient(AdaptiveClient.from_settings(client_ladder, settings.get("adapt", {})), address, path)
+
+
+def snapshot(query: Mapping[str, str]) -> Optional[EncodedFrame]:
+    """
+    The newest frame for a still image request. A cached encode younger than max_age seconds
+    is served as is, otherwise the camera is woken for a fresh frame. None if none arrives.
+    """
+    camera = get_camera()
+    variant = cap_ladder(ladder,
+                         level=query.get("level"),
+                         quality=_query_value(query, "quality", int),
+                         scale=_query_value(query, "scale", float))[0]
+    max_age = _query_value(query, "max_age", float)
+    if max_age is None:
+        max_age = settings.get("snapshot-max-age", 1.0)
+
+    frame = camera.cached(variant)
+    if frame is not None and time.monotonic() - frame.captured <= max_age:
+        return frame
+    sequence, image, captured = camera.hub.latest()
+    if image is not None and time.monotonic() - captured <= max_age:
+        return camera.encode(sequence, image, captured, variant)
+
+    with camera.subscribe():
+        return camera.wait_encoded(sequence, variant, SNAPSHOT_TIMEOUT)
+
+
+def frame_etag(frame: EncodedFrame) -> str:
+    return f'"{_ETAG_PREFIX}-{frame.sequence}-{frame.variant.scale:g}-{frame.variant.quality}"'
+
+
+def collect_metrics() -> dict:
+    cameras = {}
+    for camera in VideoCamera.cameras():
+        cameras[str(camera.source)] = dict(camera.metrics.as_dict(), subscribers=camera.subscribers)
+        if camera.motion is not None:
+            cameras[str(camera.source)].update(still=camera.motion.still, motion_score=round(camera.motion.score, 4))
+    return {
+        "cameras": cameras,
+        "clients": [client.as_dict() for client in clients.clients()],
+        "totals": clients.totals(),
+    }
+
+
+def get_mqtt() -> mqtt_client.Client:
+    """The streamer's MQTT client, connected in the background on first use"""
+    global _mqtt
+    if _mqtt is None:
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                logging.info("Connected to MQTT Broker")
+                # subscriptions don't survive a reconnect
+                for topic in _mqtt_topics:
+                    client.subscribe(topic)
+            else:
+                logging.warning(f"Failed to connect to MQTT Broker, return code {rc}")
+
+        _mqtt = mqtt_client.Client(f"kevinbot-streamer-{uuid.uuid4()}")
+        _mqtt.on_connect = on_connect
+        # MQTT is optional for streaming, so a missing broker is retried in the background instead of raising
+        _mqtt.connect_async(services["mqtt"]["address"], services["mqtt"]["port"])
+        _mqtt.loop_start()
+    return _mqtt
+
+
+def mqtt_subscribe(topic: str, callback: Callable[[mqtt_client.MQTTMessage], None]):
+    client = get_mqtt()
+    client.message_callback_add(topic, lambda _client, _userdata, message: callback(message))
+    _mqtt_topics.append(topic)
+    if client.is_connected():
+        client.subscribe(topic)
+
+
+def start_diagnostics() -> Optional[DiagnosticsPublisher]:
+    """Publish metrics over MQTT when the streamer has a diagnostics topic configured"""
+    if not settings.get("topic-diagnostics"):
+        return None
+    publisher = DiagnosticsPublisher(get_mqtt(), collect_metrics, settings["topic-diagnostics"],
+                                     settings.get("diagnostics-interval", 5))
+    publisher.start()
+    return publisher
+
+
+def start_recorder() -> Optional[VideoRecorder]:
+    """Record the camera when enabled, an estop message from the com service pins the footage around it"""
+    global recorder
+    record_settings = settings.get("record", {})
+    if not record_settings.get("enabled"):
+        return None
+    recorder = VideoRecorder.from_settings(get_camera(), record_settings, ladder)
+    recorder.start()
+
+    estop_topic = services.get("com", {}).get("topic-estop")
+    if estop_topic:
+        def on_estop(message: mqtt_client.MQTTMessage):
+            try:
+                timestamp = json.loads(message.payload)["t"]
+            except (ValueError, KeyError, TypeError):
+                timestamp = None
+            recorder.pin(timestamp)
+
+        mqtt_subscribe(estop_topic, on_estop)
+    return recorder
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (candidate.replace("W/", "", 1) for candidate in candidates)